@@ -1,16 +1,25 @@
 import argparse
+import cache
+import extract
+import gpt
 import os
-import requests
 import unicodedata
+import web
 
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
 from prompt_toolkit.history import InMemoryHistory
 from prompt_toolkit.shortcuts import prompt
 
 KEYS = ['u', 'i', 'o', 'p']
+BASE_URL = "https://arxiv.org/list/{category}/recent?skip={skip}&show={show}"
+SHOW = int(os.getenv("GPT_ARXIV_SHOW", 20))
 
 history = InMemoryHistory()
 
+# parsed listing pages, set up in __main__
+listing_cache = None
+
 
 def normalize_unicode(text):
     ascii_text = unicodedata.normalize('NFKC', text)
@@ -21,99 +30,141 @@ def get_categories():
 
     url = "https://arxiv.org/category_taxonomy"
 
-    page = requests.get(url)
+    page = web.get(url)
 
-    bs = BeautifulSoup(page.content, "html.parser")
+    bs = extract.soup(page.content, SoupStrainer("h4"))
 
     for tag in bs.find_all("h4"):
         print(tag.text)
 
 
-def get_arxiv(category, skip):
+class ListingError(Exception):
+    pass
 
-    show = 20
 
-    base_url = "https://arxiv.org/list/{category}/recent?skip={skip}&show={show}"
+def parse_listing(html_content):
+    soup = extract.soup(html_content,
+                        SoupStrainer(["a", "div", "span"]))
 
-    global history
+    arxiv_ids = []
 
-    while True:
+    for link in soup.find_all("a", title="Download PDF"):
+        arxiv_id = link.get("href").split("/")[-1]
+        arxiv_ids.append(arxiv_id)
 
-        response = requests.get(base_url.format(category=category, skip=skip, show=show))
+    titles = []
 
-        if response.status_code == 200:
-            response.encoding = 'utf-8'
-            html_content = response.text
-        else:
-            print(f"Failed to retrieve the web page: {response.status_code}")
-            html_content = ""
-            exit()
+    for div in soup.find_all("div", class_="list-title mathjax"):
+        title = " ".join(div.text.split())
+        titles.append(title.removeprefix("Title: "))
 
-        soup = BeautifulSoup(html_content, "html.parser")
+    subjects = []
 
-        arxiv_ids = []
+    for span in soup.find_all("span", class_="primary-subject"):
+        subjects.append(" ".join(span.text.split()))
 
-        for link in soup.find_all("a"):
-            href = link.get("href")
-            title = link.get("title")
-            if title == "Download PDF":
-                arxiv_id = href.split("/")[-1]
-                arxiv_ids.append(arxiv_id)
+    return [list(entry) for entry in zip(arxiv_ids, titles, subjects)]
 
-        titles = []
 
-        for div in soup.find_all("div", class_="list-title mathjax"):
-            titles.append(div.text.strip().replace("Title: ", "").replace("  ", " "))
+def fetch_listing(category, skip, show):
+    key = f"{category}:{skip}:{show}"
 
-        subjects = []
+    if listing_cache is not None:
+        entries = listing_cache.get(key)
+        if entries is not None:
+            return entries
 
-        for span in soup.find_all("span", class_="primary-subject"):
-            subjects.append(span.text.strip())
+    response = web.get(BASE_URL.format(category=category, skip=skip, show=show))
 
-        idx = 0
+    if response.status_code != 200:
+        raise ListingError(
+                f"Failed to retrieve the web page: {response.status_code}")
 
-        print(f"--- category:{category}")
+    response.encoding = 'utf-8'
+    entries = parse_listing(response.text)
 
-        while True:
+    if listing_cache is not None:
+        listing_cache.put(key, entries)
 
-            reset = False
-            j = 0
-            for i in range(idx, (idx + len(KEYS))):
-                if i >= len(arxiv_ids):
-                    reset = True
-                    break
-                print(f"({KEYS[j]}) {titles[i]} ({arxiv_ids[i]}) ({subjects[i]})")
-                j += 1
+    return entries
+
+
+def get_arxiv(category, skip, show=SHOW):
+
+    global history
+
+    # the next page is fetched and parsed while the current one is browsed
+    executor = ThreadPoolExecutor(max_workers=1)
 
-            if reset is True:
-                break
+    try:
+        pending = executor.submit(fetch_listing, category, skip, show)
+
+        while True:
 
-            print("---")
             try:
-                user_input = prompt("> ", history=history)
-            except EOFError:
-                return
+                entries = pending.result()
+            except ListingError as e:
+                print(e)
+                exit()
 
-            if normalize_unicode(user_input) == 'k':
+            if len(entries) == 0:
+                print("No more entries.")
                 return
-            elif user_input == '':
+
+            pending = executor.submit(fetch_listing, category, skip + show,
+                                      show)
+
+            idx = 0
+
+            print(f"--- category:{category}")
+
+            while True:
+
+                reset = False
+                j = 0
+                for i in range(idx, (idx + len(KEYS))):
+                    if i >= len(entries):
+                        reset = True
+                        break
+                    arxiv_id, title, subject = entries[i]
+                    print(f"({KEYS[j]}) {title} ({arxiv_id}) ({subject})")
+                    j += 1
+
+                if reset is True:
+                    break
+
                 print("---")
-                idx += len(KEYS)
-                continue
-            else:
                 try:
-                    k = KEYS.index(user_input)
-                except ValueError:
-                    print(f"Invalid input: {user_input}")
+                    user_input = prompt("> ", history=history)
+                except EOFError:
+                    return
+
+                if normalize_unicode(user_input) == 'k':
+                    return
+                elif user_input == '':
                     print("---")
+                    idx += len(KEYS)
                     continue
+                else:
+                    try:
+                        k = KEYS.index(user_input)
+                    except ValueError:
+                        print(f"Invalid input: {user_input}")
+                        print("---")
+                        continue
+
+                url = f"https://arxiv.org/pdf/{entries[idx + k][0]}.pdf"
+                print(url)
+                try:
+                    gpt.read_and_process(url)
+                except KeyboardInterrupt:
+                    print()
+                print("---")
 
-            command = f"gpt https://arxiv.org/pdf/{arxiv_ids[idx + k]}.pdf"
-            print(command)
-            os.system(command)
-            print("---")
-
-        skip += show
+            skip += show
+    finally:
+        # do not wait for a page nobody is going to read
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":
@@ -130,9 +181,19 @@ if __name__ == "__main__":
                         default=0,
                         help="Specify skip count.")
 
+    parser.add_argument('-n',
+                        '--show',
+                        type=int,
+                        default=SHOW,
+                        help="Entries per listing page "
+                        + f"(default {SHOW}).")
+
     args = parser.parse_args()
 
+    gpt.init_caches()
+    listing_cache = cache.ListingCache()
+
     if args.category is None:
         get_categories()
     else:
-        get_arxiv(args.category, args.skip)
+        get_arxiv(args.category, args.skip, args.show)
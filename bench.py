@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import stub
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def timed(func, repeat=1):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), result
+
+
+def report(results, name, value, unit, as_json=False):
+    results.append({"name": name, "value": value, "unit": unit})
+    if as_json:
+        print(json.dumps(results[-1]))
+    else:
+        print(f"{name:<32} {value:>12.2f} {unit}")
+
+
+def bench_startup(results, args):
+    def run(*argv):
+        return lambda: subprocess.run([sys.executable, *argv],
+                                      cwd=HERE,
+                                      stdout=subprocess.DEVNULL,
+                                      check=True)
+
+    sec, _ = timed(run('-c', 'import gpt'), args.repeat)
+    report(results, "startup: import gpt", sec * 1000, "ms", args.json)
+    sec, _ = timed(run('gpt.py', '--help'), args.repeat)
+    report(results, "startup: gpt.py --help", sec * 1000, "ms", args.json)
+
+
+def bench_extraction(results, args):
+    import extract
+    import gpt
+
+    pdf = stub.make_pdf(args.pages)
+    sec, text = timed(lambda: ''.join(gpt.iter_pdf_pages(io.BytesIO(pdf))),
+                      args.repeat)
+    report(results, "extract: pdf pages/s", args.pages / sec, "pages/s",
+           args.json)
+    report(results, "extract: pdf text", len(text) / sec / 1e6, "MB/s",
+           args.json)
+
+    if args.extract_workers > 1:
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as file:
+            file.write(pdf)
+            file.flush()
+            sec, _ = timed(lambda: ''.join(gpt.iter_pdf_pages_parallel(
+                    file.name, None, args.extract_workers)), args.repeat)
+        report(results, f"extract: pdf x{args.extract_workers} pages/s",
+               args.pages / sec, "pages/s", args.json)
+
+    html = stub.make_html(args.paragraphs)
+
+    backends = [('html.parser', extract.HTMLTextExtractor)]
+    if extract._load_lxml():
+        backends.append(('lxml', extract.LxmlTextExtractor))
+    for name, backend in backends:
+        def extract_html():
+            parser = backend()
+            parser.feed(html)
+            parser.close()
+            return parser.pop_text()
+
+        sec, _ = timed(extract_html, args.repeat)
+        report(results, f"extract: html ({name})", len(html) / sec / 1e6,
+               "MB/s", args.json)
+
+
+def bench_chunking(results, args):
+    import gpt
+
+    text = stub.make_text(args.paragraphs * 10)
+    for size in ('3000', '1000t'):
+        budget = gpt.parse_chunk_size(size)
+        sec, _ = timed(lambda: gpt.ChunkIndex(budget, text), args.repeat)
+        report(results, f"chunk: {size}", len(text) / sec / 1e6, "MB/s",
+               args.json)
+
+
+def bench_end_to_end(results, args):
+    import gpt
+
+    config = stub.StubConfig(tokens_per_sec=args.tokens_per_sec,
+                             first_token_delay=args.first_token_delay,
+                             reply_tokens=args.reply_tokens)
+    chat = stub.start_chat_stub(config=config)
+    fixtures = stub.start_fixture_server()
+    os.environ['OPENAI_BASE_URL'] = stub.server_url(chat) + '/v1'
+    os.environ.setdefault('OPENAI_API_KEY', 'stub')
+    gpt.openai_client = None
+
+    ttft = []
+    latency = []
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        gpt._send("warm up", None, "stub")
+        for i in range(args.repeat):
+            gpt._send(f"question {i}", None, "stub")
+            entry = gpt.recorder.select("request")[-1]
+            ttft.append(entry["ttft"])
+            latency.append(entry["latency"])
+    report(results, "send: ttft", statistics.median(ttft) * 1000, "ms",
+           args.json)
+    report(results, "send: latency", statistics.median(latency) * 1000, "ms",
+           args.json)
+
+    base = stub.server_url(fixtures)
+    for name in (f"doc.pdf?n={args.pages}", f"doc.html?n={args.paragraphs}"):
+        url = f"{base}/{name}"
+        with tempfile.TemporaryDirectory() as tmp, \
+                contextlib.redirect_stdout(io.StringIO()):
+            sec, _ = timed(lambda: gpt.process_batch([url], gpt.DEFAULT_PROMPT,
+                                                     "stub", args.chunk_size,
+                                                     output_dir=tmp,
+                                                     quiet=True,
+                                                     summarize_all=True))
+        report(results, f"document: {name.split('?')[0]}", sec * 1000, "ms",
+               args.json)
+
+    chat.shutdown()
+    fixtures.shutdown()
+
+
+SUITES = {"startup": bench_startup,
+          "extraction": bench_extraction,
+          "chunking": bench_chunking,
+          "end-to-end": bench_end_to_end}
+
+
+# CLI Interface
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Offline benchmarks for gpt.py, using the local "
+                        + "chat stub and fixture servers from stub.py.")
+    parser.add_argument('suites',
+                        nargs='*',
+                        help="Suites to run: " + ", ".join(SUITES)
+                             + ". Default is all of them.")
+    parser.add_argument('--repeat',
+                        type=int,
+                        help="Runs per measurement; the median is shown.",
+                        default=3)
+    parser.add_argument('--pages',
+                        type=int,
+                        help="Pages in the PDF fixture.",
+                        default=40)
+    parser.add_argument('--paragraphs',
+                        type=int,
+                        help="Paragraphs in the HTML fixture.",
+                        default=200)
+    parser.add_argument('--extract-workers',
+                        type=int,
+                        default=1)
+    parser.add_argument('-c',
+                        '--chunk_size',
+                        default='3000')
+    parser.add_argument('--tokens-per-sec',
+                        type=float,
+                        default=stub.DEFAULT_TOKENS_PER_SEC)
+    parser.add_argument('--first-token-delay',
+                        type=float,
+                        default=stub.DEFAULT_FIRST_TOKEN_DELAY_SEC)
+    parser.add_argument('--reply-tokens',
+                        type=int,
+                        default=stub.DEFAULT_REPLY_TOKENS)
+    parser.add_argument('--json',
+                        action='store_true',
+                        help="Print one JSON object per result.")
+    args = parser.parse_args()
+
+    for name in args.suites:
+        if name not in SUITES:
+            parser.error(f"unknown suite: {name}")
+
+    results = []
+    for name in args.suites or list(SUITES):
+        SUITES[name](results, args)
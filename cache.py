@@ -0,0 +1,326 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+CACHE_DIR = os.getenv("GPT_CACHE_DIR",
+                      os.path.expanduser("~") + "/.gpt_cache")
+RESPONSE_CACHE_SIZE = int(os.getenv("GPT_RESPONSE_CACHE_SIZE",
+                                    64 * 1024 * 1024))
+HTTP_CACHE_SIZE = int(os.getenv("GPT_HTTP_CACHE_SIZE", 512 * 1024 * 1024))
+TEXT_CACHE_SIZE = int(os.getenv("GPT_TEXT_CACHE_SIZE", 256 * 1024 * 1024))
+LISTING_CACHE_SIZE = int(os.getenv("GPT_LISTING_CACHE_SIZE", 4 * 1024 * 1024))
+LISTING_TTL_SEC = int(os.getenv("GPT_LISTING_TTL", 600))
+HTTP_CACHED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified',
+                       'Cache-Control']
+BODY_BLOCK_BYTES = 64 * 1024
+
+
+class LRUStore:
+    def __init__(self, path, max_bytes, on_evict=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        # called with each evicted key, for data kept outside the store
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                            "key TEXT PRIMARY KEY, "
+                            "value BLOB NOT NULL, "
+                            "size INTEGER NOT NULL, "
+                            "accessed REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed "
+                            "ON entries (accessed)")
+
+    def get(self, key):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT value FROM entries WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE entries SET accessed = ? WHERE key = ?",
+                            (time.time(), key))
+        return row[0]
+
+    def put(self, key, value, size=None):
+        # size counts toward max_bytes; pass it when value only
+        # describes data kept elsewhere
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return False
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO entries "
+                            "(key, value, size, accessed) "
+                            "VALUES (?, ?, ?, ?)",
+                            (key, value, size, time.time()))
+            stale = self._evict()
+        if self.on_evict is not None:
+            for key in stale:
+                self.on_evict(key)
+        return True
+
+    def delete(self, key):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _evict(self):
+        total = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        rows = self.db.execute("SELECT key, size FROM entries "
+                               "ORDER BY accessed ASC")
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append(key)
+            total -= size
+        self.db.executemany("DELETE FROM entries WHERE key = ?",
+                            [(key,) for key in stale])
+        return stale
+
+
+class ResponseCache:
+    def __init__(self, path=None, max_bytes=RESPONSE_CACHE_SIZE):
+        if path is None:
+            path = os.path.join(CACHE_DIR, "responses.db")
+        self.store = LRUStore(path, max_bytes)
+
+    @staticmethod
+    def key(model, messages):
+        payload = json.dumps({"model": model, "messages": messages},
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        value = self.store.get(key)
+        if value is None:
+            return None
+        return value.decode('utf-8')
+
+    def put(self, key, content):
+        self.store.put(key, content.encode('utf-8'))
+
+
+class CachedResponse:
+    def __init__(self, url, headers, path, not_modified=False):
+        self.url = url
+        self.status_code = 200
+        self.headers = headers
+        # the cached body file, read on first use of content
+        self.path = path
+        self.not_modified = not_modified
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            with open(self.path, 'rb') as file:
+                self._content = file.read()
+        return self._content
+
+    def raise_for_status(self):
+        pass
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+
+class HttpCache:
+    # headers in SQLite and bodies as files beside it, so a large body
+    # is written and read in blocks rather than held in memory
+    def __init__(self, path=None, max_bytes=HTTP_CACHE_SIZE):
+        if path is None:
+            path = os.path.join(CACHE_DIR, "http.db")
+        self.body_dir = os.path.splitext(path)[0] + "-bodies"
+        os.makedirs(self.body_dir, exist_ok=True)
+        self.store = LRUStore(path, max_bytes, on_evict=self._remove_body)
+
+    def body_path(self, url):
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.body_dir, name)
+
+    def fetch(self, url, get, **kwargs):
+        entry = self.lookup(url)
+        if entry is not None and entry['fresh']:
+            return CachedResponse(url, entry['headers'], entry['path'])
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.update(self.validators(entry))
+
+        response = get(url, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            return self.revalidated(url, entry, response.headers)
+
+        if response.status_code == 200:
+            self.save(url, response.headers, response.content)
+
+        return response
+
+    def lookup(self, url):
+        entry = self._load(url)
+        if entry is not None:
+            entry['fresh'] = time.time() < entry['expires']
+        return entry
+
+    @staticmethod
+    def validators(entry):
+        headers = {}
+        if entry is not None:
+            cached = entry['headers']
+            if cached.get('ETag'):
+                headers['If-None-Match'] = cached['ETag']
+            if cached.get('Last-Modified'):
+                headers['If-Modified-Since'] = cached['Last-Modified']
+        return headers
+
+    def revalidated(self, url, entry, response_headers):
+        for name in HTTP_CACHED_HEADERS:
+            if response_headers.get(name):
+                entry['headers'][name] = response_headers[name]
+        # the body file is kept as it is
+        self._save(url, entry['headers'], digest=entry['digest'])
+        return CachedResponse(url, entry['headers'], entry['path'],
+                              not_modified=True)
+
+    def save(self, url, response_headers, content):
+        # content is bytes or a binary file positioned at the body
+        headers = {name: response_headers[name]
+                   for name in HTTP_CACHED_HEADERS
+                   if response_headers.get(name)}
+        self._save(url, headers, content)
+
+    def _load(self, url):
+        value = self.store.get(url)
+        if value is None:
+            return None
+        meta, _, inline = value.partition(b'\n')
+        entry = json.loads(meta)
+        path = self.body_path(url)
+        # entries from before bodies were files are not used
+        if inline or 'digest' not in entry or not os.path.exists(path):
+            return None
+        entry['path'] = path
+        return entry
+
+    def _remove_body(self, url):
+        try:
+            os.remove(self.body_path(url))
+        except FileNotFoundError:
+            pass
+
+    def _write_body(self, url, content):
+        if isinstance(content, bytes):
+            blocks = [content]
+        else:
+            blocks = iter(lambda: content.read(BODY_BLOCK_BYTES), b'')
+
+        hasher = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.body_dir)
+        try:
+            with open(fd, 'wb') as file:
+                for data in blocks:
+                    hasher.update(data)
+                    file.write(data)
+            # readers holding the old file keep reading it
+            os.replace(tmp, self.body_path(url))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return hasher.hexdigest()
+
+    def _save(self, url, headers, content=None, digest=None):
+        directives = parse_cache_control(headers.get('Cache-Control'))
+        if 'no-store' in directives:
+            self.store.delete(url)
+            self._remove_body(url)
+            return
+
+        max_age = 0
+        if 'no-cache' not in directives:
+            try:
+                max_age = int(directives.get('max-age', 0))
+            except ValueError:
+                pass
+
+        # without a validator or freshness lifetime the body is unusable
+        if (max_age <= 0 and not headers.get('ETag')
+                and not headers.get('Last-Modified')):
+            return
+
+        if content is not None:
+            digest = self._write_body(url, content)
+        try:
+            size = os.path.getsize(self.body_path(url))
+        except FileNotFoundError:
+            # evicted while being revalidated
+            self.store.delete(url)
+            return
+
+        meta = json.dumps({"headers": headers,
+                           "expires": time.time() + max_age,
+                           "digest": digest}).encode('utf-8')
+        if not self.store.put(url, meta, size=size + len(meta)):
+            self.store.delete(url)
+            self._remove_body(url)
+
+
+class TextCache:
+    def __init__(self, path=None, max_bytes=TEXT_CACHE_SIZE):
+        if path is None:
+            path = os.path.join(CACHE_DIR, "text.db")
+        self.store = LRUStore(path, max_bytes)
+
+    @staticmethod
+    def key(digest, kind, pages=None, extractor=None):
+        key = f"{digest}:{kind}:{pages or ''}"
+        if extractor:
+            key += f":{extractor}"
+        return key
+
+    def get(self, key):
+        value = self.store.get(key)
+        if value is None:
+            return None
+        return zlib.decompress(value).decode('utf-8')
+
+    def put(self, key, text):
+        self.store.put(key, zlib.compress(text.encode('utf-8')))
+
+
+class ListingCache:
+    # parsed index pages of the browsing scripts, reused for ttl seconds
+    def __init__(self, path=None, max_bytes=LISTING_CACHE_SIZE,
+                 ttl=LISTING_TTL_SEC):
+        if path is None:
+            path = os.path.join(CACHE_DIR, "listings.db")
+        self.store = LRUStore(path, max_bytes)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.store.get(key)
+        if value is None:
+            return None
+        entry = json.loads(value)
+        if time.time() - entry["time"] > self.ttl:
+            return None
+        return entry["items"]
+
+    def put(self, key, items):
+        value = json.dumps({"time": time.time(), "items": items},
+                           ensure_ascii=False)
+        self.store.put(key, value.encode('utf-8'))
@@ -0,0 +1,199 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from array import array
+from collections import Counter, defaultdict
+
+import cache
+import search
+
+MERGE_FACTOR = 8
+
+
+def _pack(postings):
+    data = array('I')
+    for posting in postings:
+        data.extend(posting)
+    return data.tobytes()
+
+
+def _unpack(blob):
+    data = array('I')
+    data.frombytes(blob)
+    return [tuple(data[i:i + 3]) for i in range(0, len(data), 3)]
+
+
+class Corpus:
+    # Passages are indexed in immutable segments of per-term postings
+    # (passage id, term frequency, passage length). Every document adds a
+    # small segment; MERGE_FACTOR segments of one level are merged into
+    # one of the next level, dropping postings of replaced documents.
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(cache.CACHE_DIR, "corpus.db")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS documents ("
+                            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "source TEXT UNIQUE NOT NULL, "
+                            "digest TEXT NOT NULL, "
+                            "added REAL NOT NULL)")
+            # ids are never reused, so stale postings cannot match
+            self.db.execute("CREATE TABLE IF NOT EXISTS passages ("
+                            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "doc INTEGER NOT NULL, "
+                            "start INTEGER NOT NULL, "
+                            "length INTEGER NOT NULL, "
+                            "text TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS passages_doc "
+                            "ON passages (doc)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS segments ("
+                            "id INTEGER PRIMARY KEY, "
+                            "level INTEGER NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS postings ("
+                            "term TEXT NOT NULL, "
+                            "segment INTEGER NOT NULL, "
+                            "data BLOB NOT NULL, "
+                            "PRIMARY KEY (term, segment))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS postings_segment "
+                            "ON postings (segment)")
+
+    def add(self, source, text, passages):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        with self.lock, self.db:
+            row = self.db.execute("SELECT id, digest FROM documents "
+                                  "WHERE source = ?", (source,)).fetchone()
+            if row is not None:
+                if row[1] == digest:
+                    return False
+                # postings of the old passages are dropped when merged
+                self.db.execute("DELETE FROM passages WHERE doc = ?",
+                                (row[0],))
+                self.db.execute("DELETE FROM documents WHERE id = ?",
+                                (row[0],))
+
+            doc = self.db.execute("INSERT INTO documents "
+                                  "(source, digest, added) VALUES (?, ?, ?)",
+                                  (source, digest, time.time())).lastrowid
+            postings = defaultdict(list)
+            for start, passage in passages:
+                counts = Counter(search.tokenize(passage))
+                length = sum(counts.values())
+                if length == 0:
+                    continue
+                passage_id = self.db.execute(
+                        "INSERT INTO passages (doc, start, length, text) "
+                        "VALUES (?, ?, ?, ?)",
+                        (doc, start, length, passage)).lastrowid
+                for term, tf in counts.items():
+                    postings[term].append((passage_id, tf, length))
+
+            self._write_segment(0, postings)
+            self._merge()
+        return True
+
+    def _write_segment(self, level, postings):
+        if not postings:
+            return
+        segment = self.db.execute("INSERT INTO segments (level) VALUES (?)",
+                                  (level,)).lastrowid
+        self.db.executemany("INSERT INTO postings (term, segment, data) "
+                            "VALUES (?, ?, ?)",
+                            [(term, segment, _pack(items))
+                             for term, items in postings.items()])
+
+    def _merge(self):
+        level = 0
+        while True:
+            segments = [row[0] for row in self.db.execute(
+                    "SELECT id FROM segments WHERE level = ? ORDER BY id",
+                    (level,))]
+            if len(segments) < MERGE_FACTOR:
+                return
+
+            marks = ','.join('?' * len(segments))
+            merged = defaultdict(list)
+            for term, data in self.db.execute(
+                    f"SELECT term, data FROM postings WHERE segment IN "
+                    f"({marks}) ORDER BY segment", segments):
+                merged[term].extend(_unpack(data))
+
+            ids = [p[0] for items in merged.values() for p in items]
+            live = set()
+            if ids:
+                live = {row[0] for row in self.db.execute(
+                        "SELECT id FROM passages WHERE id BETWEEN ? AND ?",
+                        (min(ids), max(ids)))}
+            for term in list(merged):
+                merged[term] = [p for p in merged[term] if p[0] in live]
+                if not merged[term]:
+                    del merged[term]
+
+            self.db.execute(f"DELETE FROM postings WHERE segment IN ({marks})",
+                            segments)
+            self.db.execute(f"DELETE FROM segments WHERE id IN ({marks})",
+                            segments)
+            self._write_segment(level + 1, merged)
+            level += 1
+
+    def stats(self):
+        with self.lock:
+            documents = self.db.execute(
+                    "SELECT COUNT(*) FROM documents").fetchone()[0]
+            passages, length = self.db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(length), 0) "
+                    "FROM passages").fetchone()
+            segments = self.db.execute(
+                    "SELECT COUNT(*) FROM segments").fetchone()[0]
+        return {"documents": documents,
+                "passages": passages,
+                "length": length,
+                "segments": segments}
+
+    def search(self, query, k=5):
+        terms = sorted(set(search.tokenize(query)))
+        stats = self.stats()
+        if not terms or stats["passages"] == 0:
+            return []
+
+        marks = ','.join('?' * len(terms))
+        with self.lock:
+            rows = self.db.execute(f"SELECT term, data FROM postings "
+                                   f"WHERE term IN ({marks})",
+                                   terms).fetchall()
+
+        postings = defaultdict(list)
+        for term, data in rows:
+            postings[term].extend(_unpack(data))
+
+        avg_len = max(stats["length"] / stats["passages"], 1)
+        scores = defaultdict(float)
+        for items in postings.values():
+            for passage_id, tf, length in items:
+                scores[passage_id] += search.bm25(tf, len(items), length,
+                                                  avg_len, stats["passages"])
+
+        # postings of replaced documents may linger until merged
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        results = []
+        with self.lock:
+            for passage_id, score in ranked:
+                row = self.db.execute(
+                        "SELECT documents.source, passages.start, "
+                        "passages.text FROM passages JOIN documents "
+                        "ON documents.id = passages.doc "
+                        "WHERE passages.id = ?", (passage_id,)).fetchone()
+                if row is None:
+                    continue
+                results.append({"source": row[0],
+                                "start": row[1],
+                                "text": row[2],
+                                "score": score})
+                if len(results) >= k:
+                    break
+        return results
@@ -0,0 +1,190 @@
+import html.parser
+import importlib
+import os
+
+# 'lxml', 'html.parser', or unset to use lxml when it is installed
+HTML_PARSER = os.getenv("GPT_HTML_PARSER")
+# text held back while looking for <main> or <article>
+MAIN_SEARCH_CHARS = 64 * 1024
+# bumped whenever extracted text changes, to miss cached older text
+EXTRACTOR_VERSION = 3
+
+_lxml = None
+
+
+def _load_lxml():
+    global _lxml
+
+    if _lxml is None:
+        try:
+            _lxml = importlib.import_module('lxml.etree')
+        except ImportError:
+            _lxml = False
+    return _lxml
+
+
+def parser_name():
+    if HTML_PARSER is not None:
+        return HTML_PARSER
+    return 'lxml' if _load_lxml() else 'html.parser'
+
+
+def extractor_id():
+    return f"{parser_name()}-{EXTRACTOR_VERSION}"
+
+
+def soup(markup, parse_only=None):
+    # parse_only takes a bs4.SoupStrainer, so that only the elements a
+    # scraper needs are turned into a tree
+    bs4 = importlib.import_module('bs4')
+    return bs4.BeautifulSoup(markup, parser_name(), parse_only=parse_only)
+
+
+class TextCollector:
+    SKIPPED_TAGS = ('script', 'style', 'template', 'noscript', 'svg')
+    BOILERPLATE_TAGS = ('nav', 'aside', 'form', 'button', 'select', 'iframe')
+    PAGE_TAGS = ('header', 'footer')
+    MAIN_TAGS = ('main', 'article')
+
+    def __init__(self):
+        self.skipping = 0
+        self.data = []
+        self.parts = []
+        self.held = []
+        self.held_chars = 0
+        self.main_depth = 0
+        self.found_main = False
+        self.searching = True
+        self.started = False
+
+    def start_tag(self, tag):
+        self._flush()
+        if tag in self.SKIPPED_TAGS or tag in self.BOILERPLATE_TAGS:
+            self.skipping += 1
+        elif tag in self.PAGE_TAGS and self.main_depth == 0:
+            # page headers and footers, not those inside an article
+            self.skipping += 1
+        elif tag in self.MAIN_TAGS and self.skipping == 0:
+            # not a teaser card inside a sidebar, menu or footer
+            self.main_depth += 1
+            if self.searching:
+                self.found_main = True
+                self.searching = False
+                self.held = []
+
+    def end_tag(self, tag):
+        self._flush()
+        if tag in self.MAIN_TAGS:
+            if self.skipping == 0 and self.main_depth > 0:
+                self.main_depth -= 1
+        elif (tag in self.SKIPPED_TAGS or tag in self.BOILERPLATE_TAGS
+              or tag in self.PAGE_TAGS) and self.skipping > 0:
+            self.skipping -= 1
+
+    def text(self, data):
+        # a text node may arrive in pieces when it spans two feeds
+        if self.skipping == 0:
+            self.data.append(data)
+
+    def finish(self):
+        self._flush()
+        self._release()
+
+    def pop_text(self):
+        # text seen since the last call, separated like get_text(' ')
+        if not self.parts:
+            return ''
+        text = ' '.join(self.parts)
+        if self.started:
+            text = ' ' + text
+        self.started = True
+        self.parts = []
+        return text
+
+    def _release(self):
+        self.searching = False
+        self.parts.extend(self.held)
+        self.held = []
+
+    def _flush(self):
+        data = ''.join(self.data).strip()
+        self.data = []
+        if not data:
+            return
+        if self.main_depth > 0:
+            self.parts.append(data)
+        elif self.searching:
+            self.held.append(data)
+            self.held_chars += len(data)
+            if self.held_chars > MAIN_SEARCH_CHARS:
+                # no main content marked up; stream everything
+                self._release()
+        elif not self.found_main:
+            self.parts.append(data)
+
+
+class HTMLTextExtractor(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.collector = TextCollector()
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start_tag(tag)
+
+    def handle_endtag(self, tag):
+        self.collector.end_tag(tag)
+
+    def handle_comment(self, data):
+        self.collector._flush()
+
+    def handle_data(self, data):
+        self.collector.text(data)
+
+    def close(self):
+        super().close()
+        self.collector.finish()
+
+    def pop_text(self):
+        return self.collector.pop_text()
+
+
+class LxmlTextExtractor:
+    # same interface, parsed incrementally by libxml2
+    def __init__(self):
+        self.collector = TextCollector()
+        self.parser = _load_lxml().HTMLParser(target=self)
+
+    # parser target callbacks
+    def start(self, tag, attrib):
+        self.collector.start_tag(tag)
+
+    def end(self, tag):
+        self.collector.end_tag(tag)
+
+    def data(self, data):
+        self.collector.text(data)
+
+    def comment(self, text):
+        self.collector._flush()
+
+    # extractor interface
+    def feed(self, data):
+        if data:
+            self.parser.feed(data)
+
+    def close(self):
+        try:
+            self.parser.close()
+        except _load_lxml().XMLSyntaxError:
+            # nothing was fed
+            pass
+        self.collector.finish()
+
+    def pop_text(self):
+        return self.collector.pop_text()
+
+
+def create_text_extractor():
+    if parser_name() == 'lxml':
+        return LxmlTextExtractor()
+    return HTMLTextExtractor()
@@ -1,140 +1,1029 @@
 #!/usr/bin/env python3
 
+import time
+
+# taken before the other imports so --profile-startup can show them
+_STARTUP_TIME = time.perf_counter()
+
 import argparse
-import filetype
+import atexit
+import cache
+import codecs
+import corpus
+import extract
+import hashlib
+import importlib
+import itertools
+import json
+import metrics
+import mmap
 import os
-import openai
 import pprint
+import queue
+import random
 import re
-import requests
+import search
+import shutil
+import sys
+import tempfile
+import threading
 import unicodedata
 
-from bs4 import BeautifulSoup
-from collections import deque
+from bisect import bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from io import BytesIO
-from prompt_toolkit.history import FileHistory
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.shortcuts import prompt
 
-from pypdf import PdfReader
+# openai, pypdf, filetype, prompt_toolkit and requests (via web) are
+# loaded on first use by _lazy_import, so a one-shot question does not pay
+# for the document parsing libraries. So are asyncio (batch mode and
+# --summarize-all) and multiprocessing (--extract-workers).
+_import_times = [("module imports", time.perf_counter() - _STARTUP_TIME)]
 
 # Initialize Logging and .env
 load_dotenv()
 
-# OpenAI
-openai_client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY", ""))
+# PDF reader of an --extract-workers process
+_worker_pdf = None
+
+# OpenAI, created on first use
+openai_client = None
+_openai_client_lock = threading.Lock()
+_import_lock = threading.RLock()
 
 # Constants
+DEFAULT_BATCH_CONCURRENCY = 4
 DEFAULT_CHUNK_SIZE = 3000
 DEFAULT_PROMPT = os.getenv(
         "GPT_DEFAULT_PROMPT",
         "Please summarize the following sentences:")
 DEFAULT_TALK_QUEUE_SIZE = 8
+MEMORY_TOKENS = int(os.getenv("GPT_MEMORY_TOKENS", 4000))
+MEMORY_SUMMARY_SHARE = 0.25
+MEMORY_COMPACT_TARGET = 0.75
+ASK_TOP_K = int(os.getenv("GPT_ASK_TOP_K", 4))
+CORPUS_PASSAGE_CHARS = 1500
+CORPUS_TOP_K = int(os.getenv("GPT_CORPUS_TOP_K", 6))
+GIST_CHARS = 200
+SEND_RETRIES = int(os.getenv("GPT_SEND_RETRIES", 3))
+SEND_RETRY_BASE_SEC = 0.5
+SEND_RETRY_MAX_SEC = 8.0
+SEND_RETRY_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+HEDGE_AFTER_SEC = float(os.getenv("GPT_HEDGE_AFTER", 0))
+RENDER_FLUSH_SEC = 0.05
+RENDER_TTY_CHARS = 256
+RENDER_BLOCK_CHARS = 8192
 DEFAULT_TIMEOUT_SEC = 30
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+MAX_DOWNLOAD_BYTES = int(os.getenv("GPT_MAX_DOWNLOAD", 200 * 1024 * 1024))
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+PDF_PAGES_PER_TASK = 4
 GPT4, GPT35 = "gpt-4-turbo-preview", "gpt-3.5-turbo"
 INPUT_HISTORY = os.path.expanduser("~") + "/.gpt_prompt_history"
 SYSTEM_PROMPT = os.getenv("GPT_SYSTEM_PROMPT", None)
+ASK_PROMPT = os.getenv(
+        "GPT_ASK_PROMPT",
+        "Answer the question using only the document excerpts in the "
+        "user message. Mention the chunk numbers you used.")
+CORPUS_PROMPT = os.getenv(
+        "GPT_CORPUS_PROMPT",
+        "Answer the question using only the passages in the user message, "
+        "which come from documents I have read. Cite the passage numbers "
+        "you used.")
+REDUCE_PROMPT = os.getenv(
+        "GPT_REDUCE_PROMPT",
+        "The following are summaries of consecutive parts of one document. "
+        "Combine them into a single summary:")
+
+# Text measurement
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff'
+                         r'\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+BOUNDARY_PATTERNS = [
+    re.compile(r'\n\s*\n'),              # paragraph
+    re.compile(r'[.!?](?=\s)|[。！？]'),   # sentence
+    re.compile(r'\s'),                   # word
+]
 
 
 # Classes
-class FixedSizeArray:
-    def __init__(self, size):
-        self.size = size
-        self.array = deque(maxlen=size)
+class ConversationMemory:
+    def __init__(self, max_tokens=MEMORY_TOKENS, max_messages=None):
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.messages = []
+        self.sizes = []
+        self.tokens = 0
+        self.summary = deque()
+        self.summary_tokens = 0
+        self.history = []
 
     def append(self, item):
-        self.array.append(item)
+        size = estimate_tokens(item['content'])
+        self.messages.append(item)
+        self.sizes.append(size)
+        self.tokens += size
+        if self._compact():
+            self._rebuild()
+        else:
+            self.history.append(item)
 
     def get_array(self):
-        return list(self.array)
+        # shared with the caller, not a copy
+        return self.history
 
     def get(self, index):
-        return self.array[index]
+        return self.messages[index]
 
     def get_size(self):
-        return len(self.array)
+        return len(self.messages)
 
     def clear(self):
-        self.array.clear()
+        self.messages.clear()
+        self.sizes.clear()
+        self.tokens = 0
+        self.summary.clear()
+        self.summary_tokens = 0
+        self.history = []
 
     def dump(self):
-        pprint.pprint(self.array)
+        if self.summary:
+            pprint.pprint(list(self.summary))
+        pprint.pprint(self.messages)
+        print(f"~{self.tokens + self.summary_tokens}/{self.max_tokens} tokens")
+
+    def _over_budget(self, share=1.0):
+        if (self.max_messages is not None
+                and len(self.messages) > self.max_messages):
+            return True
+        return self.tokens + self.summary_tokens > self.max_tokens * share
+
+    def _compact(self):
+        if not self._over_budget():
+            return False
+
+        # compact below the budget so that the history, a prefix of every
+        # request, stays unchanged and prompt-cacheable for a few turns.
+        # The latest exchange always stays whole, even when over budget.
+        compacted = False
+        while (len(self.messages) > 2
+               and self._over_budget(MEMORY_COMPACT_TARGET)):
+            pair = self.messages[:2]
+            self.tokens -= self.sizes[0] + self.sizes[1]
+            del self.messages[:2]
+            del self.sizes[:2]
+            self._summarize(pair)
+            compacted = True
+        return compacted
+
+    def _summarize(self, pair):
+        line = " / ".join(f"{item['role']}: {gist(item['content'])}"
+                          for item in pair)
+        self.summary.append(line)
+        self.summary_tokens += estimate_tokens(line)
+        limit = self.max_tokens * MEMORY_SUMMARY_SHARE
+        while self.summary and self.summary_tokens > limit:
+            self.summary_tokens -= estimate_tokens(self.summary.popleft())
+
+    def _rebuild(self):
+        self.history = []
+        if self.summary:
+            self.history.append({"role": "system",
+                                 "content": "Earlier in this conversation:\n"
+                                            + "\n".join(self.summary)})
+        self.history.extend(self.messages)
+
+
+class ChunkBudget(namedtuple('ChunkBudget', ['size', 'unit'])):
+    def __str__(self):
+        if self.unit == 'tokens':
+            return f"{self.size} tokens"
+        return str(self.size)
+
+
+class ChunkIndex:
+    def __init__(self, budget, text=None):
+        self.budget = parse_chunk_size(budget)
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.offsets = [0]
+        # text not yet cut into chunks starts at pending[start:]
+        self.pending = ''
+        self.start = 0
+        self.complete = False
+        # every piece was read, not cut short by cancel() or an error
+        self.read_all = text is not None
+        # set to stop the producer, including a download in progress
+        self.stopped = threading.Event()
+        self.thread = None
+        if text is not None:
+            self.feed(text)
+            self.close()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __getitem__(self, i):
+        return self.chunks[i]
+
+    @property
+    def length(self):
+        with self.cond:
+            return self.offsets[-1] + len(self.pending) - self.start
+
+    @property
+    def cancelled(self):
+        return self.stopped.is_set()
+
+    @property
+    def text(self):
+        with self.cond:
+            return ''.join(self.chunks) + self.pending[self.start:]
+
+    def feed(self, text):
+        with self.cond:
+            self.pending += text
+            while self._exceeds(self._head()):
+                self._cut(final=False)
+            self._compact()
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            while self.start < len(self.pending):
+                self._cut(final=True)
+            self._compact()
+            self.complete = True
+            self.cond.notify_all()
+
+    def consume(self, pieces):
+        # build the index from an iterable of text on a background thread
+        self.thread = threading.Thread(target=self._consume,
+                                       args=(pieces,),
+                                       daemon=True)
+        self.thread.start()
+
+    def cancel(self, wait=True):
+        self.stopped.set()
+        if wait and self.thread is not None:
+            self.thread.join()
+
+    def ensure(self, i):
+        # wait until chunk i exists or no more text will arrive
+        with self.cond:
+            self.cond.wait_for(lambda: self.complete or i < len(self.chunks))
+
+    def wait(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.complete)
+
+    def ensure_offset(self, pos):
+        with self.cond:
+            self.cond.wait_for(lambda: self.complete or pos < self.offsets[-1])
+
+    def locate(self, pos):
+        i = bisect_right(self.offsets, max(pos, 0)) - 1
+        return min(i, max(len(self.chunks) - 1, 0))
+
+    def resize(self, budget):
+        with self.cond:
+            text = self.text
+            self.budget = parse_chunk_size(budget)
+            self.chunks = []
+            self.offsets = [0]
+            self.pending = ''
+            self.start = 0
+            self.feed(text)
+            if self.complete:
+                self.close()
+
+    def _consume(self, pieces):
+        try:
+            for piece in pieces:
+                if self.cancelled:
+                    break
+                self.feed(piece)
+            else:
+                self.read_all = True
+        except Exception as e:
+            if not self.cancelled:
+                print(e)
+        finally:
+            if hasattr(pieces, 'close'):
+                pieces.close()
+            self.close()
+
+    def _exceeds(self, text):
+        if self.budget.unit == 'chars':
+            return len(text) > self.budget.size
+        return (len(text) > self.budget.size * 4
+                or estimate_tokens(text) > self.budget.size)
+
+    def _limit(self, text):
+        # longest prefix of text that fits the budget
+        if not self._exceeds(text):
+            return len(text)
+        if self.budget.unit == 'chars':
+            return self.budget.size
+        lo, hi = self.budget.size, min(len(text), self.budget.size * 4)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if estimate_tokens(text[:mid]) <= self.budget.size:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def _head(self):
+        # the most one chunk can take plus one character, so that cutting
+        # a long text does not copy the rest of it for every chunk
+        if self.budget.unit == 'chars':
+            size = self.budget.size + 1
+        else:
+            size = self.budget.size * 4 + 1
+        return self.pending[self.start:self.start + size]
+
+    def _compact(self):
+        if self.start > 0:
+            self.pending = self.pending[self.start:]
+            self.start = 0
+
+    def _cut(self, final):
+        head = self._head()
+        limit = self._limit(head)
+        if limit == len(head) and final:
+            end = limit
+        else:
+            end = _snap_to_boundary(head, limit)
+        chunk = head[:end]
+        self.start += end
+        # the offset first: readers that do not hold the lock index
+        # offsets[len(chunks)]
+        self.offsets.append(self.offsets[-1] + len(chunk))
+        self.chunks.append(chunk)
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class ChunkPrefetcher:
+    def __init__(self, count):
+        self.count = count
+        self.futures = {}
+        self.executor = None
+        if count > 0:
+            self.executor = ThreadPoolExecutor(max_workers=count)
+
+    def schedule(self, index, i, prmt, model):
+        if self.executor is None:
+            return
+
+        # drop work for chunks the reader has already moved past
+        pos = index.offsets[min(i, len(index))]
+        for key in [key for key in self.futures if key < pos]:
+            self.futures.pop(key).cancel()
+
+        for k in range(i + 1, min(i + 1 + self.count, len(index))):
+            key = index.offsets[k]
+            if key in self.futures:
+                continue
+            self.futures[key] = self.executor.submit(_complete, index[k],
+                                                     model, True, prmt)
+
+    def take(self, idx):
+        future = self.futures.pop(idx, None)
+        # a request that has not started yet is better sent in the foreground
+        if future is None or future.cancel():
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(e)
+            return None
+
+    def reset(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+
+    def shutdown(self):
+        self.reset()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ChunkRetriever:
+    def __init__(self, index):
+        self.index = index
+        self.reset()
+
+    def reset(self):
+        self.bm25 = search.BM25Index()
+
+    def search(self, query, k=ASK_TOP_K):
+        # chunks that arrived since the last search are indexed first
+        while len(self.bm25) < len(self.index):
+            self.bm25.add(self.index[len(self.bm25)])
+        return sorted(doc for doc, _ in self.bm25.search(query, k))
 
 
 # Global conversation
 conversation = None
 
-# prompt_toolkit
-kb = KeyBindings()
+# Response cache, enabled with --cache or GPT_RESPONSE_CACHE=1
+response_cache = None
+
+# HTTP cache for fetched documents, disabled with --no-cache
+http_cache = None
+
+# Extracted document text by content hash, disabled with --no-cache
+text_cache = None
+
+# Passages of every document read, searched with --corpus
+doc_corpus = None
+
+# Download size limit, set with --max-download
+max_download_bytes = MAX_DOWNLOAD_BYTES
+
+# Conversation memory budget, set with --memory-tokens
+memory_tokens = MEMORY_TOKENS
 
+# Request, fetch and extract timings, written to --trace
+recorder = metrics.Recorder()
 
-@kb.add('escape', 'enter')
-def _(event):
+# Retries and hedging for chat requests, set with --retries
+# and --hedge-after/--hedge-model
+send_retries = SEND_RETRIES
+hedge_after = HEDGE_AFTER_SEC
+hedge_model = None
+
+# Reply output, 'text' or 'ndjson', set with --stream-format
+stream_format = 'text'
+
+# Download progress on stderr, off in batch mode
+download_progress = True
+
+# prompt_toolkit, key bindings are built on first use
+kb = None
+
+
+def insert_newline(event):
     event.current_buffer.insert_text('\n')
 
 
-@kb.add('enter')
-def _(event):
+def accept_input(event):
     event.current_buffer.validate_and_handle()
 
 
-@kb.add('c-u')
 def insert_user_message(event):
     if conversation is not None and conversation.get_size() > 1:
         text = conversation.get(-2)['content']
         event.app.current_buffer.insert_text(text)
 
 
-@kb.add('c-i')
 def insert_gpt_message(event):
     if conversation is not None and conversation.get_size() > 0:
         text = conversation.get(-1)['content']
         event.app.current_buffer.insert_text(text)
 
 
+def key_bindings():
+    global kb
+
+    if kb is None:
+        kb = _lazy_import('prompt_toolkit.key_binding').KeyBindings()
+        kb.add('escape', 'enter')(insert_newline)
+        kb.add('enter')(accept_input)
+        kb.add('c-u')(insert_user_message)
+        kb.add('c-i')(insert_gpt_message)
+    return kb
+
+
+def prompt(message, **kwargs):
+    return _lazy_import('prompt_toolkit.shortcuts').prompt(message, **kwargs)
+
+
+def file_history():
+    return _lazy_import('prompt_toolkit.history').FileHistory(INPUT_HISTORY)
+
+
 # Helper Functions
-def _send(message, conversation, model, quiet=False):
+def _lazy_import(name):
+    # sys.modules holds half-initialized modules while another thread
+    # is still importing them
+    with _import_lock:
+        module = sys.modules.get(name)
+        if module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(name)
+            _import_times.append((f"import {name}",
+                                  time.perf_counter() - start))
+    return module
+
+
+def get_openai_client():
+    global openai_client
+
+    with _openai_client_lock:
+        if openai_client is None:
+            openai = _lazy_import('openai')
+            # retries are done by _retry, with jitter and hedging
+            openai_client = openai.OpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY", ""),
+                    max_retries=0)
+    return openai_client
+
+
+def create_async_openai_client():
+    openai = _lazy_import('openai')
+    # retried by _retry_async, like the blocking client
+    return openai.AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY", ""),
+                              max_retries=0)
+
+
+def print_startup_profile():
+    rows = list(_import_times)
+    rows.append(("total since startup", time.perf_counter() - _STARTUP_TIME))
+    print("\n--- startup profile", file=sys.stderr)
+    for name, sec in rows:
+        print(f"{sec * 1000:9.1f} ms  {name}", file=sys.stderr)
+
+
+def estimate_tokens(text):
+    # CJK characters are roughly one token each, other text about four
+    # characters per token.
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def parse_chunk_size(value):
+    if isinstance(value, ChunkBudget):
+        return value
+
+    match = re.match(r'^(\d+)\s*(t|tok|tokens)?$', str(value).strip().lower())
+    if not match:
+        raise ValueError(f"Invalid chunk size: {value}")
+
+    unit = 'chars' if match.group(2) is None else 'tokens'
+    return ChunkBudget(max(int(match.group(1)), 1), unit)
+
+
+def _chunk_budget(chunk_size, prmt):
+    # a token budget covers the whole request, not just the chunk
+    budget = parse_chunk_size(chunk_size)
+    if budget.unit == 'tokens':
+        overhead = estimate_tokens(prmt) + estimate_tokens(SYSTEM_PROMPT or '')
+        budget = ChunkBudget(max(budget.size - overhead, 1), 'tokens')
+    return budget
+
+
+def measure(text, budget):
+    if budget.unit == 'tokens':
+        return estimate_tokens(text)
+    return len(text)
+
+
+def group_for_context(texts, budget, separator="\n\n"):
+    # every group but the last has at least two members, so each
+    # round of grouping shrinks the list
+    groups = []
+    group = []
+    size = 0
+    for text in texts:
+        length = measure(separator + text, budget)
+        if len(group) >= 2 and size + length > budget.size:
+            groups.append(group)
+            group = []
+            size = 0
+        group.append(text)
+        size += length
+    if group:
+        groups.append(group)
+    return groups
+
+
+def gist(text, limit=GIST_CHARS):
+    text = ' '.join(text.split())
+    if len(text) <= limit:
+        return text
+    return text[:_snap_to_boundary(text, limit)].rstrip() + " ..."
+
+
+def _snap_to_boundary(text, limit):
+    floor = limit // 2
+    for pattern in BOUNDARY_PATTERNS:
+        last = None
+        for last in pattern.finditer(text, floor, limit):
+            pass
+        if last is not None:
+            return last.end()
+    return limit
 
-    message = message.strip()
 
+def _build_messages(message, conversation, instructions=None):
+
+    # most stable first, so that requests share a long prefix that
+    # the provider can serve from its prompt cache
     messages = []
 
-    if conversation is not None:
-        messages.extend(conversation.get_array())
-
     if SYSTEM_PROMPT is not None:
         messages.append({"role": "system", "content": SYSTEM_PROMPT})
 
+    if instructions is not None:
+        messages.append({"role": "system", "content": instructions})
+
+    if conversation is not None:
+        messages += conversation.get_array()
+
     messages.append({"role": "user", "content": message})
 
-    all_content = ""
+    return messages
+
+
+def _cache_key(model, messages, use_cache):
+    if response_cache is None or use_cache is False:
+        return None
+    return response_cache.key(model, messages)
+
+
+def _request_record(model, messages, mode):
+    return {"model": model,
+            "mode": mode,
+            "prompt_chars": sum(len(m['content']) for m in messages),
+            "prompt_tokens": sum(estimate_tokens(m['content'])
+                                 for m in messages)}
+
+
+def _record_usage(record, usage):
+    if usage is None:
+        return
+    record["usage_prompt_tokens"] = usage.prompt_tokens
+    record["usage_completion_tokens"] = usage.completion_tokens
+    details = getattr(usage, 'prompt_tokens_details', None)
+    record["cached_tokens"] = getattr(details, 'cached_tokens', None) or 0
+
+
+def _record_completion(record, content, start, cache_hit=False):
+    latency = time.perf_counter() - start
+    record.update({"completion_chars": len(content),
+                   "bytes": len(content.encode('utf-8')),
+                   "ttft": latency,
+                   "latency": latency})
+    if cache_hit:
+        record["cache"] = "hit"
+    recorder.record("request", **record)
+
+
+def _complete(message, model, use_cache=True, instructions=None):
+
+    messages = _build_messages(message.strip(), None, instructions)
+    record = _request_record(model, messages, "complete")
+    start = time.perf_counter()
+
+    cache_key = _cache_key(model, messages, use_cache)
+    if cache_key is not None:
+        content = response_cache.get(cache_key)
+        if content is not None:
+            _record_completion(record, content, start, cache_hit=True)
+            return content
 
     try:
+        response = _retry(lambda: get_openai_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            timeout=DEFAULT_TIMEOUT_SEC
+        ), record)
+    except Exception as e:
+        recorder.record("request", error=str(e), **record)
+        raise
+
+    content = response.choices[0].message.content or ""
+    if cache_key is not None and content != "":
+        response_cache.put(cache_key, content)
+
+    _record_usage(record, getattr(response, 'usage', None))
+    _record_completion(record, content, start)
+    return content
+
+
+def _stream_deltas(response, record=None):
+    for chunk in response:
+        # the usage report comes last, in a chunk without choices
+        if record is not None and getattr(chunk, 'usage', None) is not None:
+            _record_usage(record, chunk.usage)
+        if chunk.choices:
+            yield chunk.choices[0].delta.content
+
+
+def _is_transient(e):
+    openai = _lazy_import('openai')
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    return getattr(e, 'status_code', None) in SEND_RETRY_STATUSES
+
+
+def _retry_delay(attempt, e):
+    delay = min(SEND_RETRY_MAX_SEC, SEND_RETRY_BASE_SEC * 2 ** attempt)
+    delay *= random.uniform(0.5, 1.0)
+    response = getattr(e, 'response', None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get('retry-after'))
+            delay = max(delay, min(retry_after, SEND_RETRY_MAX_SEC * 4))
+        except (TypeError, ValueError):
+            pass
+    return delay
 
-        response = openai_client.chat.completions.create(
+
+def _retry(call, record=None):
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Exception as e:
+            if attempt >= send_retries or not _is_transient(e):
+                raise
+            if record is not None:
+                record["retries"] = record.get("retries", 0) + 1
+            time.sleep(_retry_delay(attempt, e))
+            attempt += 1
+
+
+async def _retry_async(call, record=None):
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except Exception as e:
+            if attempt >= send_retries or not _is_transient(e):
+                raise
+            if record is not None:
+                record["retries"] = record.get("retries", 0) + 1
+            await _lazy_import('asyncio').sleep(_retry_delay(attempt, e))
+            attempt += 1
+
+
+def _open_stream(messages, model, record=None):
+    # waits for the first piece of text so that failures before it
+    # can be retried without anything having been printed
+
+    def attempt():
+        response = get_openai_client().chat.completions.create(
             model=model,
             messages=messages,
             stream=True,
+            stream_options={"include_usage": True},
             timeout=DEFAULT_TIMEOUT_SEC
         )
+        deltas = _stream_deltas(response, record)
+        try:
+            for first in deltas:
+                if first:
+                    return response, itertools.chain([first], deltas)
+        except Exception:
+            response.close()
+            raise
+        return response, iter([])
 
-        if quiet is False:
-            print(f"({model}):\n")
+    return _retry(attempt, record)
+
+
+def _close_losers(results, pending):
+    for _ in range(pending):
+        _, response, _, _ = results.get()
+        if response is not None:
+            response.close()
+
+
+def _open_hedged(messages, model, record=None):
+    if not hedge_after or hedge_after <= 0:
+        response, deltas = _open_stream(messages, model, record)
+        return deltas, model
+
+    results = queue.Queue()
+
+    def attempt(attempt_model):
+        try:
+            response, deltas = _open_stream(messages, attempt_model, record)
+        except Exception as e:
+            results.put((attempt_model, None, None, e))
+            return
+        results.put((attempt_model, response, deltas, None))
+
+    threading.Thread(target=attempt, args=(model,), daemon=True).start()
+    pending = 1
+    hedged = False
+    error = None
+    while pending > 0:
+        try:
+            result = results.get(timeout=None if hedged else hedge_after)
+        except queue.Empty:
+            hedged = True
+            pending += 1
+            if record is not None:
+                record["hedged"] = True
+            threading.Thread(target=attempt,
+                             args=(hedge_model or model,),
+                             daemon=True).start()
+            continue
+
+        pending -= 1
+        winner, response, deltas, e = result
+        if e is not None:
+            error = e
+            continue
+
+        # the slower request is closed as soon as it answers
+        if pending > 0:
+            threading.Thread(target=_close_losers,
+                             args=(results, pending),
+                             daemon=True).start()
+        return deltas, winner
+
+    raise error
+
+
+class StreamRenderer:
+    def __init__(self, model, quiet=False, out=None, start=None,
+                 events=None, timed=True):
+        self.model = model
+        self.quiet = quiet
+        # False for an answer that was already in memory
+        self.timed = timed
+        self.out = sys.stdout if out is None else out
+        self.events = stream_format == 'ndjson' if events is None else events
+        # small timed writes on a terminal, large blocks on pipes
+        self.tty = self.out.isatty() and not self.events
+        self.flush_chars = RENDER_TTY_CHARS if self.tty else RENDER_BLOCK_CHARS
+        self.start = time.perf_counter() if start is None else start
+        self.first = None
+        self.last_flush = self.start
+        self.parts = []
+        self.pending = []
+        self.pending_chars = 0
+        # flushes what a pause in the stream would otherwise leave hidden
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def begin(self):
+        if self.events:
+            self._event(event="start", model=self.model)
+        elif self.quiet is False:
+            self.out.write(f"({self.model}):\n\n")
+            self.out.flush()
+
+    def feed(self, text):
+        if not text:
+            return
+
+        now = time.perf_counter()
+        first = self.first is None
+        if first:
+            self.first = now
+
+        with self.lock:
+            self.parts.append(text)
+            self.pending.append(text)
+            self.pending_chars += len(text)
+
+            if (first or self.pending_chars >= self.flush_chars
+                    or (self.tty
+                        and now - self.last_flush >= RENDER_FLUSH_SEC)):
+                self._flush(now)
+            elif self.tty and self.timer is None:
+                self.timer = threading.Timer(RENDER_FLUSH_SEC, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self, now=None):
+        with self.lock:
+            self._flush(now)
+
+    def _flush(self, now=None):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        text = ''.join(self.pending)
+        self.pending.clear()
+        self.pending_chars = 0
+
+        if self.events:
+            self._event(event="delta", text=text)
+        else:
+            self.out.write(text)
+        self.out.flush()
+        self.last_flush = time.perf_counter() if now is None else now
+
+    def finish(self):
+        self.flush()
+        content = ''.join(self.parts)
+        stats = self.stats(len(content))
+        self.result = stats
+
+        if self.events:
+            if not self.timed:
+                stats = {"model": self.model, "chars": stats["chars"]}
+            self._event(event="end", **stats)
+        elif (self.quiet is False and self.timed
+              and stats["ttft"] is not None):
+            print(f"\n[{stats['ttft']:.2f}s to first token, "
+                  + f"{stats['chars']} chars, "
+                  + f"{stats['chars_per_sec']:.0f} chars/s]",
+                  end="", file=sys.stderr, flush=True)
+
+        return content
+
+    def stats(self, chars):
+        end = time.perf_counter()
+        ttft = None if self.first is None else self.first - self.start
+        streaming = end - (self.start if self.first is None else self.first)
+        return {"model": self.model,
+                "chars": chars,
+                "ttft": ttft,
+                "elapsed": end - self.start,
+                "chars_per_sec": chars / streaming if streaming > 0 else 0.0}
+
+    def _event(self, **event):
+        self.out.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def _render(deltas, model, quiet=False, start=None, record=None,
+            timed=True):
+
+    renderer = StreamRenderer(model, quiet, start=start, timed=timed)
+    renderer.begin()
+
+    for chunk_message in deltas:
+        renderer.feed(chunk_message)
+
+    content = renderer.finish()
+    if record is not None:
+        record.update({"completion_chars": renderer.result["chars"],
+                       "bytes": len(content.encode('utf-8')),
+                       "ttft": renderer.result["ttft"],
+                       "latency": renderer.result["elapsed"]})
+    return content
+
+
+def _report_error(message, model):
+    # an error event keeps --stream-format ndjson output parseable
+    if stream_format == 'ndjson':
+        print(json.dumps({"event": "error", "model": model,
+                          "message": message}, ensure_ascii=False),
+              flush=True)
+    else:
+        print(message)
+
+
+def _send(message, conversation, model, quiet=False, use_cache=True,
+          instructions=None):
+
+    message = message.strip()
+
+    messages = _build_messages(message, conversation, instructions)
+    record = _request_record(model, messages, "stream")
+
+    all_content = ""
+
+    start = time.perf_counter()
+    try:
+
+        cache_key = _cache_key(model, messages, use_cache)
+        cached = None
+        if cache_key is not None:
+            cached = response_cache.get(cache_key)
+
+        if cached is not None:
+            record["cache"] = "hit"
+            deltas = [cached]
+        else:
+            deltas, answered_by = _open_hedged(messages, model, record)
+            if answered_by != model:
+                record["answered_by"] = answered_by
+                model = answered_by
 
-        for chunk in response:
-            chunk_message = chunk.choices[0].delta.content
-            if chunk_message:
-                all_content += chunk_message
-                print(chunk_message, end="", flush=True)
+        all_content = _render(deltas, model, quiet, start, record)
 
-        if conversation is not None:
+        if all_content == "":
+            record["error"] = "empty reply"
+            _report_error("ERROR: The reply was empty.", model)
+        elif conversation is not None:
             conversation.append({"role": "user", "content": message})
             conversation.append({"role": "assistant", "content": all_content})
 
+        if (cache_key is not None and cached is None and all_content != ""
+                and record.get("answered_by") is None):
+            response_cache.put(cache_key, all_content)
+
     except Exception as e:
-        print(e)
+        record["error"] = str(e)
+        record["latency"] = time.perf_counter() - start
+        _report_error(str(e), model)
 
+    recorder.record("request", **record)
     return all_content
 
 
@@ -166,40 +1055,336 @@ def normalize_unicode(text):
     return ascii_text
 
 
-def read_pdf(byte_stream, pages=None):
+def _select_pages(page_count, pages):
     if pages is None:
-        pages_array = None
-    else:
-        pages_array = expand_page_range(pages)
+        return list(range(1, page_count + 1))
+    return sorted(n for n in set(expand_page_range(pages))
+                  if 1 <= n <= page_count)
+
+
+def iter_pdf_pages(byte_stream, pages=None):
+    reader = _lazy_import('pypdf').PdfReader(byte_stream)
+
+    for n in _select_pages(len(reader.pages), pages):
+        yield ' ' + reader.pages[n - 1].extract_text()
+
+
+def _init_pdf_worker(file_name):
+    # runs once per worker process, which opens the file on its own
+    global _worker_pdf
 
-    reader = PdfReader(byte_stream)
-    text = ''
-    for i, page in enumerate(reader.pages, start=1):
-        if (pages_array is None) or (i in pages_array):
-            text += ' ' + page.extract_text()
-    return text
+    fh = open(file_name, "rb")
+    mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker_pdf = _lazy_import('pypdf').PdfReader(mm)
 
 
-def fetch_url_content(url, pages=None):
+def _extract_pdf_pages(page_nums):
+    return [' ' + _worker_pdf.pages[n - 1].extract_text()
+            for n in page_nums]
+
+
+def iter_pdf_pages_parallel(file_name, pages=None, workers=2):
+    with open(file_name, "rb") as fh:
+        reader = _lazy_import('pypdf').PdfReader(fh)
+        page_nums = _select_pages(len(reader.pages), pages)
+
+    size = max(PDF_PAGES_PER_TASK, len(page_nums) // (workers * 16))
+    batches = iter([page_nums[i:i + size]
+                    for i in range(0, len(page_nums), size)])
+
+    # spawn, since the caller usually runs on a ChunkIndex thread
+    futures_process = _lazy_import('concurrent.futures.process')
+    spawn = _lazy_import('multiprocessing').get_context('spawn')
+    pool = futures_process.ProcessPoolExecutor(max_workers=workers,
+                                               mp_context=spawn,
+                                               initializer=_init_pdf_worker,
+                                               initargs=(file_name,))
     try:
-        response = requests.get(url, timeout=DEFAULT_TIMEOUT_SEC)
+        # keep a bounded number of batches in flight and yield in page order
+        futures = deque(pool.submit(_extract_pdf_pages, batch)
+                        for batch in itertools.islice(batches, workers * 2))
+        while futures:
+            texts = futures.popleft().result()
+            for batch in itertools.islice(batches, 1):
+                futures.append(pool.submit(_extract_pdf_pages, batch))
+            yield from texts
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _traced(kind, pieces, trace):
+    start = time.perf_counter()
+    chars = 0
+    try:
+        for piece in pieces:
+            chars += len(piece)
+            yield piece
     except Exception as e:
-        print(e)
+        trace["error"] = str(e)
+        raise
+    finally:
+        trace["chars"] = chars
+        trace["seconds"] = time.perf_counter() - start
+        recorder.record(kind, **trace)
+
+
+def iter_pdf_file_text(file_name, pages=None, extract_workers=1):
+    trace = {"file": file_name, "pages": pages, "workers": extract_workers}
+    return _traced("extract",
+                   _iter_pdf_file_text(file_name, pages, extract_workers,
+                                       trace),
+                   trace)
+
+
+def _iter_pdf_file_text(file_name, pages, extract_workers, trace):
+    with open(file_name, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            key = _text_cache_key('application/pdf',
+                                  hashlib.sha256(mm).hexdigest(),
+                                  pages)
+            text = text_cache.get(key) if key is not None else None
+            if text is not None:
+                trace["cache"] = "hit"
+                yield text
+                return
+
+            if extract_workers > 1:
+                pieces = iter_pdf_pages_parallel(file_name,
+                                                 pages,
+                                                 extract_workers)
+            else:
+                pieces = iter_pdf_pages(mm, pages)
+            if key is not None:
+                pieces = _store_text(pieces, key)
+            yield from pieces
+
+
+def add_to_corpus_later(source, index):
+    # indexed on its own thread once the chunker has closed, so neither
+    # the last chunk nor reading waits on the corpus
+    if doc_corpus is None:
+        return
+
+    def run():
+        index.wait()
+        if index.read_all:
+            add_to_corpus(source, index.text)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def add_to_corpus(source, text):
+    if doc_corpus is None or text == '':
+        return
+    index = ChunkIndex(ChunkBudget(CORPUS_PASSAGE_CHARS, 'chars'), text)
+    passages = [(index.offsets[i], index[i]) for i in range(len(index))]
+    try:
+        doc_corpus.add(source, text, passages)
+    except Exception as e:
+        print(f"Corpus: {e}", file=sys.stderr)
+
+
+def _store_text(pieces, key):
+    # only a fully extracted document is worth caching
+    parts = []
+    for piece in pieces:
+        parts.append(piece)
+        yield piece
+    text_cache.put(key, ''.join(parts))
+
+
+def read_pdf(byte_stream, pages=None):
+    return ''.join(iter_pdf_pages(byte_stream, pages))
+
+
+def _text_cache_key(content_type, digest, pages):
+    if text_cache is None:
+        return None
+    kind = content_type.split(';')[0].strip()
+    if kind == 'text/html':
+        return text_cache.key(digest, kind, pages, extract.extractor_id())
+    if kind == 'application/pdf':
+        return text_cache.key(digest, kind, pages)
+    return None
+
+
+def _charset(content_type):
+    match = re.search(r'charset=["\']?([\w.:-]+)', content_type, re.I)
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+def _show_progress(done, total):
+    if not download_progress or not sys.stderr.isatty():
         return
+    if done is None:
+        print(file=sys.stderr)
+    elif total >= done:
+        print(f"\r{done // 1024}/{total // 1024} KB", end="",
+              file=sys.stderr, flush=True)
+    else:
+        print(f"\r{done // 1024} KB", end="", file=sys.stderr, flush=True)
 
-    response.raise_for_status()
 
-    content_type = response.headers['Content-Type']
+def _iter_download(response, spool, hasher, stopped=None):
+    total = int(response.headers.get('Content-Length') or 0)
+    done = 0
+    try:
+        for data in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+            # raised, not returned, so a partial body is never cached
+            if stopped is not None and stopped.is_set():
+                raise DownloadCancelled(response.url)
+            done += len(data)
+            if done > max_download_bytes:
+                raise ValueError(f"Download exceeds {max_download_bytes} "
+                                 + f"bytes: {response.url}")
+            spool.write(data)
+            hasher.update(data)
+            _show_progress(done, total)
+            yield data
+    finally:
+        if done > 0:
+            _show_progress(None, total)
+
+
+def _iter_markup_text(chunks, content_type):
+    decoder = codecs.getincrementaldecoder(_charset(content_type))('replace')
+
+    if 'text/html' not in content_type:
+        for data in chunks:
+            text = decoder.decode(data)
+            if text:
+                yield text
+        yield decoder.decode(b'', final=True)
+        return
 
-    content = response.content
+    parser = extract.create_text_extractor()
+    for data in chunks:
+        parser.feed(decoder.decode(data))
+        text = parser.pop_text()
+        if text:
+            yield text
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    yield parser.pop_text()
 
+
+def _iter_pdf_text(stream, pages, extract_workers):
+    if extract_workers <= 1:
+        yield from iter_pdf_pages(stream, pages)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as tmp:
+        shutil.copyfileobj(stream, tmp)
+        tmp.flush()
+        yield from iter_pdf_pages_parallel(tmp.name, pages, extract_workers)
+
+
+def _iter_body_text(content_type, chunks, spool, hasher, pages,
+                    extract_workers):
     if 'application/pdf' in content_type:
-        return read_pdf(BytesIO(content), pages)
-    elif 'text/html' in content_type:
-        soup = BeautifulSoup(content, 'html.parser')
-        return soup.get_text(' ', strip=True)
+        # the cross-reference table is at the end, so wait for all of it
+        for _ in chunks:
+            pass
+        key = _text_cache_key(content_type, hasher.hexdigest(), pages)
+        text = text_cache.get(key) if key is not None else None
+        if text is not None:
+            yield text
+            return
+        spool.seek(0)
+        pieces = _iter_pdf_text(spool, pages, extract_workers)
+        if key is not None:
+            pieces = _store_text(pieces, key)
+        yield from pieces
     else:
-        return content.decode('utf-8')
+        parts = []
+        for text in _iter_markup_text(chunks, content_type):
+            parts.append(text)
+            yield text
+        key = _text_cache_key(content_type, hasher.hexdigest(), pages)
+        if key is not None:
+            text_cache.put(key, ''.join(parts))
+
+
+def _iter_blocks(stream, hasher):
+    for data in iter(lambda: stream.read(DOWNLOAD_CHUNK_BYTES), b''):
+        hasher.update(data)
+        yield data
+
+
+def _iter_cached_text(entry, pages, extract_workers):
+    content_type = entry['headers'].get('Content-Type', '')
+
+    key = _text_cache_key(content_type, entry['digest'], pages)
+    text = text_cache.get(key) if key is not None else None
+    if text is not None:
+        yield text
+        return
+
+    # the cached body file is read in blocks, like a download
+    with open(entry['path'], 'rb') as body:
+        hasher = hashlib.sha256()
+        yield from _iter_body_text(content_type, _iter_blocks(body, hasher),
+                                   body, hasher, pages, extract_workers)
+
+
+def iter_url_text(url, pages=None, extract_workers=1, stopped=None):
+    trace = {"url": url}
+    return _traced("fetch",
+                   _iter_url_text(url, pages, extract_workers, trace,
+                                  stopped),
+                   trace)
+
+
+def _iter_url_text(url, pages, extract_workers, trace, stopped=None):
+    entry = None
+    if http_cache is not None:
+        entry = http_cache.lookup(url)
+        if entry is not None and entry['fresh']:
+            trace["cache"] = "fresh"
+            yield from _iter_cached_text(entry, pages, extract_workers)
+            return
+
+    with _lazy_import('web').get(url,
+                                 headers=cache.HttpCache.validators(entry),
+                                 stream=True,
+                                 timeout=DEFAULT_TIMEOUT_SEC) as response:
+        if response.status_code == 304 and entry is not None:
+            http_cache.revalidated(url, entry, response.headers)
+            trace["cache"] = "revalidated"
+            yield from _iter_cached_text(entry, pages, extract_workers)
+            return
+
+        response.raise_for_status()
+
+        content_type = response.headers.get('Content-Type', '')
+        hasher = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(SPOOL_MEMORY_BYTES) as spool:
+            chunks = _iter_download(response, spool, hasher, stopped)
+            yield from _iter_body_text(content_type, chunks, spool, hasher,
+                                       pages, extract_workers)
+
+            size = spool.seek(0, os.SEEK_END)
+            trace["bytes"] = size
+            if http_cache is not None and size <= http_cache.store.max_bytes:
+                spool.seek(0)
+                http_cache.save(url, response.headers, spool)
+
+
+def fetch_url_content(url, pages=None, extract_workers=1):
+    try:
+        return ''.join(iter_url_text(url, pages, extract_workers))
+    except Exception as e:
+        print(e)
 
 
 # Processing Functions
@@ -209,21 +1394,24 @@ def process_talk(source, model, depth):
 
     if source is not None:
         _send(source, conversation=None, model=model)
-        print()
+        if stream_format != 'ndjson':
+            print()
     else:
-        history = FileHistory(INPUT_HISTORY)
-        conversation = FixedSizeArray(depth)
+        history = file_history()
+        conversation = ConversationMemory(memory_tokens, depth)
         while True:
             try:
                 user_input = prompt("(You): ",
                                     history=history,
-                                    key_bindings=kb,
+                                    key_bindings=key_bindings(),
                                     multiline=True)
                 user_input = user_input.strip()
                 if normalize_unicode(user_input) == 'k':
                     break
 
                 # special commands
+                use_cache = '@nocache' not in user_input
+                user_input = user_input.replace('@nocache', '').strip()
                 if user_input.startswith("@4"):
                     user_input = user_input.removeprefix("@4")
                     model = GPT4
@@ -237,55 +1425,121 @@ def process_talk(source, model, depth):
                 elif user_input == '@clear':
                     conversation.clear()
                     continue
+                elif user_input == '@stats':
+                    print(recorder.summary())
+                    continue
 
                 if user_input == '':
                     continue
 
-                print("---")
-                _send(user_input, conversation=conversation, model=model)
-                print("\n---")
+                events = stream_format == 'ndjson'
+                if not events:
+                    print("---")
+                _send(user_input,
+                      conversation=conversation,
+                      model=model,
+                      use_cache=use_cache)
+                if not events:
+                    print("\n---")
             except UnicodeDecodeError as e:
-                print(e)
+                _report_error(str(e), model)
             except EOFError:
                 break
 
 
-def process_chunks(text, prmt, model, chunk_size, depth, start_pos):
+def process_chunks(text, prmt, model, chunk_size, depth, start_pos,
+                   prefetch=0):
 
     global conversation
 
-    read_count = start_pos
-    text_length = len(text)
-    if text_length == 0:
+    if isinstance(text, ChunkIndex):
+        index = text
+    else:
+        index = ChunkIndex(_chunk_budget(chunk_size, prmt), text)
+
+    index.ensure(0)
+    if index.length == 0:
         print("ERROR: Text is empty.")
         return
 
-    history = FileHistory(INPUT_HISTORY)
-    conversation = FixedSizeArray(depth)
-
-    idx = start_pos
+    history = file_history()
+    conversation = ConversationMemory(memory_tokens, depth)
+    prefetcher = ChunkPrefetcher(prefetch)
+    retriever = ChunkRetriever(index)
+    try:
+        _process_chunks(index, prmt, model, start_pos, history, prefetcher,
+                        retriever)
+    finally:
+        prefetcher.shutdown()
+
+
+def _ask(index, retriever, question, model, use_cache=True):
+
+    hits = retriever.search(question)
+    if len(hits) == 0:
+        print("No matching chunks.")
+        return ""
+
+    print(f"(chunks {', '.join(str(i + 1) for i in hits)}"
+          + ("" if index.complete else ", document still loading") + ")")
+    excerpts = "\n\n".join(f"[Chunk {i + 1}]\n{index[i]}" for i in hits)
+    content = _send(f"{excerpts}\n\nQuestion: {question}",
+                    None,
+                    model,
+                    use_cache=use_cache,
+                    instructions=ASK_PROMPT)
+    if content != "":
+        conversation.append({"role": "user", "content": question})
+        conversation.append({"role": "assistant", "content": content})
+    return content
+
+
+def _process_chunks(index, prmt, model, start_pos, history, prefetcher,
+                    retriever):
+
+    index.ensure_offset(start_pos)
+    i = index.locate(start_pos)
     while True:
-        chunk = text[idx:idx+chunk_size]
+        index.ensure(i)
+        chunk = index[i] if i < len(index) else ''
+        prefetcher.schedule(index, i, prmt, model)
+        next_i = i + 1
         if len(chunk) > 0:
             print("---")
-            message = f"{prmt}\n\n{chunk}"
-            content = _send(message, None, model)
-            conversation.append({"role": "user", "content": message})
-            conversation.append({"role": "assistant", "content": content})
+            content = prefetcher.take(index.offsets[i])
+            if content is None:
+                content = _send(chunk, None, model, instructions=prmt)
+            else:
+                # answered in the background; its timing is not this one's
+                content = _render([content], model, timed=False)
+            if content == "":
+                # nothing to remember; Enter sends this chunk again
+                print("(Press Enter to retry this chunk.)")
+                next_i = i
+            else:
+                # keep the summary, not the raw chunk, for side questions
+                conversation.append({"role": "user",
+                                     "content": f"{prmt} (chunk {i + 1}, "
+                                                + "characters "
+                                                + f"{index.offsets[i]}"
+                                                + f"-{index.offsets[i + 1]})"})
+                conversation.append({"role": "assistant", "content": content})
             print()
 
-        read_count += chunk_size
-        if read_count >= text_length:
-            read_count = text_length
-
-        consumed = read_count / text_length * 100
         try:
             while True:
+                read_count = index.offsets[min(i + 1, len(index))]
+                text_length = f"{index.length}"
+                if not index.complete:
+                    text_length += '+'
+                consumed = read_count / index.length * 100
                 user_input = prompt(
                         f"---({read_count}/{text_length})"
-                        + f"({consumed:.2f}%)\n(You): ",
+                        + f"({consumed:.2f}%)"
+                        + f"({min(i + 1, len(index))}/{len(index)})"
+                        + "\n(You): ",
                         history=history,
-                        key_bindings=kb,
+                        key_bindings=key_bindings(),
                         multiline=True)
                 user_input = user_input.strip()
 
@@ -295,12 +1549,19 @@ def process_chunks(text, prmt, model, chunk_size, depth, start_pos):
 
                     # special commands
                     tmp_model = model
+                    use_cache = '@nocache' not in user_input
+                    user_input = user_input.replace('@nocache', '').strip()
+                    # a model prefix applies to @ask as well
                     if user_input.startswith("@4"):
-                        user_input = user_input.removeprefix("@4")
+                        user_input = user_input.removeprefix("@4").strip()
                         tmp_model = GPT4
                     elif user_input.startswith("@3"):
-                        user_input = user_input.removeprefix("@3")
+                        user_input = user_input.removeprefix("@3").strip()
                         tmp_model = GPT35
+
+                    if user_input == '@stats':
+                        print(recorder.summary())
+                        continue
                     elif '@raw' in user_input:
                         if user_input == '@raw':
                             print(chunk)
@@ -310,21 +1571,36 @@ def process_chunks(text, prmt, model, chunk_size, depth, start_pos):
                         pattern = r'^@goto (\d+)'
                         match = re.search(pattern, user_input)
                         if match:
-                            idx = int(match.group(1))
-                            if idx < 0:
-                                idx = 0
-                            print(f"going to {idx}")
-                            read_count = idx
+                            index.ensure_offset(int(match.group(1)))
+                            next_i = index.locate(int(match.group(1)))
+                            print(f"going to {index.offsets[next_i]}")
+                            prefetcher.reset()
                             break
                     elif user_input.startswith("@chunk"):
-                        pattern = r'^@chunk (\d+)'
+                        pattern = r'^@chunk (\d+\s*[a-z]*)$'
                         match = re.search(pattern, user_input)
                         if match:
-                            chunk_size = int(match.group(1))
-                            if chunk_size < 1:
-                                chunk_size = 1
+                            try:
+                                chunk_size = parse_chunk_size(match.group(1))
+                            except ValueError as e:
+                                print(e)
+                                continue
+                            pos = index.offsets[min(i, len(index))]
+                            index.resize(_chunk_budget(chunk_size, prmt))
+                            i = index.locate(pos)
+                            next_i = i + 1
                             print(f"chunk_size has been set to {chunk_size}")
+                            prefetcher.reset()
+                            retriever.reset()
                             continue
+                    elif user_input.startswith("@ask"):
+                        question = user_input.removeprefix("@ask").strip()
+                        if question != '':
+                            print("== Document question ==")
+                            _ask(index, retriever, question, tmp_model,
+                                 use_cache)
+                            print("\n====")
+                        continue
 
                     if user_input == '':
                         continue
@@ -332,25 +1608,37 @@ def process_chunks(text, prmt, model, chunk_size, depth, start_pos):
                     print("== Side conversation ==")
                     _send(user_input,
                           conversation=conversation,
-                          model=tmp_model)
+                          model=tmp_model,
+                          use_cache=use_cache)
                     print("\n====")
                 else:
                     break
 
-            idx += chunk_size
+            i = next_i
         except EOFError:
             break
 
 
-def check_chunks(text, prmt, model, chunk_size, depth):
-    history = FileHistory(INPUT_HISTORY)
-    start_pos = 0
+def check_chunks(text, prmt, model, chunk_size, depth, prefetch=0,
+                 start_pos=0):
+    history = file_history()
+    chunk_size = parse_chunk_size(chunk_size)
+    if isinstance(text, ChunkIndex):
+        index = text
+    else:
+        index = ChunkIndex(_chunk_budget(chunk_size, prmt), text)
+    index.ensure_offset(start_pos)
+    start_pos = index.offsets[index.locate(start_pos)]
     try:
         while True:
-            consumed = start_pos / len(text) * 100
-            user_input = prompt(f"---({start_pos}/{len(text)})"
+            length = f"{index.length}"
+            if not index.complete:
+                length += '+'
+            consumed = start_pos / index.length * 100
+            user_input = prompt(f"---({start_pos}/{length})"
                                 + f"({consumed:.2f}%)"
-                                + f"(chunk_size={chunk_size}): ",
+                                + f"(chunk_size={chunk_size})"
+                                + f"(chunks={len(index)}): ",
                                 history=history)
 
             user_input = user_input.strip()
@@ -360,21 +1648,23 @@ def check_chunks(text, prmt, model, chunk_size, depth):
                 pattern = r'^@goto (\d+)'
                 match = re.search(pattern, user_input)
                 if match:
-                    i = int(match.group(1))
-                    if i < 0:
-                        i = 0
-                    print(f"going to {i}")
-                    start_pos = i
+                    index.ensure_offset(int(match.group(1)))
+                    start_pos = index.offsets[
+                            index.locate(int(match.group(1)))]
+                    print(f"going to {start_pos}")
                     continue
             elif user_input.startswith("@chunk"):
-                pattern = r'^@chunk (\d+)'
+                pattern = r'^@chunk (\d+\s*[a-z]*)$'
                 match = re.search(pattern, user_input)
                 if match:
-                    i = int(match.group(1))
-                    if i < 1:
-                        i = 1
-                    print(f"chunk_size has been set to {i}")
-                    chunk_size = i
+                    try:
+                        chunk_size = parse_chunk_size(match.group(1))
+                    except ValueError as e:
+                        print(e)
+                        continue
+                    index.resize(_chunk_budget(chunk_size, prmt))
+                    start_pos = index.offsets[index.locate(start_pos)]
+                    print(f"chunk_size has been set to {chunk_size}")
                     continue
             if user_input == '':
                 break
@@ -384,43 +1674,440 @@ def check_chunks(text, prmt, model, chunk_size, depth):
     except EOFError:
         return
 
-    process_chunks(text, prmt, model, chunk_size, depth, start_pos)
+    process_chunks(index, prmt, model, chunk_size, depth, start_pos,
+                   prefetch)
 
 
-def process_pdf(file_name, prmt, model, chunk_size, depth):
-    with open(file_name, "rb") as fh:
-        text = read_pdf(BytesIO(fh.read()), pages)
+def process_pdf(file_name, prmt, model, chunk_size, depth, pages=None,
+                prefetch=0, extract_workers=1, start_pos=0):
+    index = ChunkIndex(_chunk_budget(chunk_size, prmt))
+    index.consume(iter_pdf_file_text(file_name, pages, extract_workers))
+    add_to_corpus_later(os.path.abspath(file_name), index)
+    try:
+        index.ensure(0)
+        if index.length > 0:
+            check_chunks(index, prmt, model, chunk_size, depth, prefetch,
+                         start_pos)
+        else:
+            print("No matched pages.")
+    finally:
+        index.cancel()
 
-    if text != '':
-        check_chunks(text, prmt, model, chunk_size, depth)
-    else:
-        print("No matched pages.")
 
+def process_url(url, prmt, model, chunk_size, depth, pages=None,
+                prefetch=0, extract_workers=1, start_pos=0):
+    index = ChunkIndex(_chunk_budget(chunk_size, prmt))
+    index.consume(iter_url_text(url, pages, extract_workers, index.stopped))
+    add_to_corpus_later(url, index)
+    try:
+        index.ensure(0)
+        if index.length > 0:
+            check_chunks(index, prmt, model, chunk_size, depth, prefetch,
+                         start_pos)
+        else:
+            print(f"No content: {url}")
+    finally:
+        # the download stops at its next block, which closes the
+        # connection and the spool; do not wait on a stalled read
+        index.cancel(wait=False)
 
-def process_text(file_name, prmt, model, chunk_size, depth):
+
+def process_text(file_name, prmt, model, chunk_size, depth, prefetch=0,
+                 start_pos=0):
     with open(file_name, 'r', encoding='utf-8') as file:
         text = file.read()
         if text != '':
-            check_chunks(text, prmt, model, chunk_size, depth)
-
-
-def read_and_process(source, prmt, model, chunk_size, depth, pages):
+            index = ChunkIndex(_chunk_budget(chunk_size, prmt), text)
+            add_to_corpus_later(os.path.abspath(file_name), index)
+            check_chunks(index, prmt, model, chunk_size, depth, prefetch,
+                         start_pos)
+
+
+def init_caches(response=None, http=True, text=True, documents=None):
+    global response_cache, http_cache, text_cache, doc_corpus
+
+    if response is None:
+        response = os.getenv("GPT_RESPONSE_CACHE") == "1"
+    if documents is None:
+        documents = os.getenv("GPT_CORPUS", "1") != "0"
+
+    response_cache = cache.ResponseCache() if response else None
+    http_cache = cache.HttpCache() if http else None
+    text_cache = cache.TextCache() if text else None
+    doc_corpus = corpus.Corpus() if documents else None
+
+
+def ask_corpus(question, model, k=CORPUS_TOP_K):
+
+    if doc_corpus is None:
+        print("The corpus is disabled (GPT_CORPUS=0).")
+        return ""
+
+    start = time.perf_counter()
+    hits = doc_corpus.search(question, k)
+    elapsed = time.perf_counter() - start
+    if len(hits) == 0:
+        print("No matching passages.")
+        return ""
+
+    sources = {hit['source'] for hit in hits}
+    print(f"({len(hits)} passages from {len(sources)} documents "
+          + f"in {elapsed * 1000:.0f} ms)")
+    for n, hit in enumerate(hits, 1):
+        print(f"[{n}] {hit['source']} @{hit['start']}")
+    print("---")
+
+    passages = "\n\n".join(f"[{n}] {hit['source']}\n{hit['text']}"
+                            for n, hit in enumerate(hits, 1))
+    content = _send(f"{passages}\n\nQuestion: {question}",
+                    None,
+                    model,
+                    instructions=CORPUS_PROMPT)
+    print()
+    return content
+
+
+def read_and_process(source,
+                     prmt=DEFAULT_PROMPT,
+                     model=GPT35,
+                     chunk_size=DEFAULT_CHUNK_SIZE,
+                     depth=DEFAULT_TALK_QUEUE_SIZE,
+                     pages=None,
+                     prefetch=0,
+                     extract_workers=1,
+                     start_pos=0):
     if source.startswith("http"):
-        text = fetch_url_content(source, pages)
-        if text != '':
-            check_chunks(text, prmt, model, chunk_size, depth)
-            return
+        process_url(source, prmt, model, chunk_size, depth, pages, prefetch,
+                    extract_workers, start_pos)
+        return
 
     if os.path.exists(source):
-        kind = filetype.guess(source)
+        kind = _lazy_import('filetype').guess(source)
         if kind and kind.extension == 'pdf':
-            process_pdf(source, prmt, model, chunk_size, depth)
+            process_pdf(source, prmt, model, chunk_size, depth, pages,
+                        prefetch, extract_workers, start_pos)
         else:
-            process_text(source, prmt, model, chunk_size, depth)
+            process_text(source, prmt, model, chunk_size, depth, prefetch,
+                         start_pos)
     else:
         process_talk(source, model, depth)
 
 
+def load_text(source, pages=None, extract_workers=1):
+    if source.startswith("http"):
+        return ''.join(iter_url_text(source, pages, extract_workers))
+
+    kind = _lazy_import('filetype').guess(source)
+    if kind and kind.extension == 'pdf':
+        return ''.join(iter_pdf_file_text(source, pages, extract_workers))
+
+    with open(source, 'r', encoding='utf-8') as file:
+        return file.read()
+
+
+def read_source_list(file_name):
+    sources = []
+    with open(file_name, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                sources.append(line)
+    return sources
+
+
+async def _complete_async(client, semaphore, message, model,
+                          instructions=None):
+
+    messages = _build_messages(message.strip(), None, instructions)
+    record = _request_record(model, messages, "batch")
+
+    cache_key = _cache_key(model, messages, True)
+    if cache_key is not None:
+        content = response_cache.get(cache_key)
+        if content is not None:
+            _record_completion(record, content, time.perf_counter(),
+                               cache_hit=True)
+            return content
+
+    start = time.perf_counter()
+
+    async def attempt():
+        nonlocal start
+        # the slot is given up while waiting to retry
+        async with semaphore:
+            start = time.perf_counter()
+            return await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                timeout=DEFAULT_TIMEOUT_SEC
+            )
+
+    try:
+        response = await _retry_async(attempt, record)
+    except Exception as e:
+        recorder.record("request", error=str(e), **record)
+        raise
+
+    content = response.choices[0].message.content or ""
+    if cache_key is not None and content != "":
+        response_cache.put(cache_key, content)
+
+    _record_usage(record, getattr(response, 'usage', None))
+    _record_completion(record, content, start)
+    return content
+
+
+async def _batch_chunk(client, semaphore, source, index, i, prmt, model):
+    record = {"source": source,
+              "chunk": i + 1,
+              "start": index.offsets[i],
+              "end": index.offsets[i + 1],
+              "model": model}
+    try:
+        record["content"] = await _complete_async(client,
+                                                  semaphore,
+                                                  index[i],
+                                                  model,
+                                                  prmt)
+    except Exception as e:
+        record["error"] = str(e)
+    return record
+
+
+async def _map_reduce(client, semaphore, index, prmt, model, chunk_size,
+                      start_pos=0, status=None):
+
+    chunks = range(index.locate(start_pos), len(index))
+    if status is not None:
+        status(f"Summarizing {len(chunks)} chunks...")
+    asyncio = _lazy_import('asyncio')
+    results = await asyncio.gather(*(
+            _map_chunk(client, semaphore, index, i, prmt, model, status)
+            for i in chunks))
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if chunks and len(errors) == len(results):
+        raise errors[-1]
+
+    # failed chunks are marked so the combined summary can mention the gap
+    summaries = []
+    for i, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            summaries.append(f"[Chunk {i + 1} ({index.offsets[i]}-"
+                             + f"{index.offsets[i + 1]}) could not be "
+                             + "summarized.]")
+        else:
+            summaries.append(result)
+
+    budget = _chunk_budget(chunk_size, REDUCE_PROMPT)
+    level = 0
+    while len(summaries) > 1:
+        level += 1
+        groups = group_for_context(summaries, budget)
+        if status is not None:
+            status(f"Combining {len(summaries)} summaries "
+                   + f"in {len(groups)} batches (level {level})...")
+        summaries = await asyncio.gather(*(
+                _reduce_group(client, semaphore, group, model, status)
+                for group in groups))
+
+    return summaries[0] if summaries else ""
+
+
+async def _map_chunk(client, semaphore, index, i, prmt, model, status):
+    try:
+        return await _complete_async(client, semaphore, index[i], model,
+                                     prmt)
+    except Exception as e:
+        if status is not None:
+            status(f"ERROR: chunk {i + 1}: {e}")
+        return e
+
+
+async def _reduce_group(client, semaphore, group, model, status=None):
+    if len(group) == 1:
+        return group[0]
+    try:
+        return await _complete_async(client, semaphore, "\n\n".join(group),
+                                     model, REDUCE_PROMPT)
+    except Exception as e:
+        # the uncombined summaries are passed up to the next level
+        if status is not None:
+            status(f"ERROR: combining {len(group)} summaries: {e}")
+        return "\n\n".join(group)
+
+
+async def _batch_source(client, semaphore, load_semaphore, source, prmt,
+                        model, chunk_size, pages, start_pos,
+                        extract_workers, summarize_all=False):
+    asyncio = _lazy_import('asyncio')
+    async with load_semaphore:
+        text = await asyncio.to_thread(load_text,
+                                       source,
+                                       pages,
+                                       extract_workers)
+
+    index = ChunkIndex(_chunk_budget(chunk_size, prmt), text)
+    if index.length == 0:
+        return [{"source": source, "error": "Text is empty."}]
+
+    if summarize_all:
+        content = await _map_reduce(client, semaphore, index, prmt, model,
+                                    chunk_size, start_pos)
+        return [{"source": source, "model": model, "content": content}]
+
+    return await asyncio.gather(*(
+            _batch_chunk(client, semaphore, source, index, i, prmt, model)
+            for i in range(index.locate(start_pos), len(index))))
+
+
+def _batch_file_name(source):
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]
+    name = re.sub(r'[^\w.-]+', '_', source).strip('_')[-80:]
+    return f"{name}-{digest}"
+
+
+def _format_batch_records(records, output_format):
+    if output_format == 'jsonl':
+        return ''.join(json.dumps(record, ensure_ascii=False) + '\n'
+                       for record in records)
+
+    lines = [f"# {records[0]['source']}", ""]
+    for record in records:
+        if 'chunk' in record:
+            lines.append(f"## Chunk {record['chunk']} "
+                         + f"({record['start']}-{record['end']})")
+            lines.append("")
+        if 'error' in record:
+            lines.append(f"> ERROR: {record['error']}")
+        else:
+            lines.append(record['content'])
+        lines.append("")
+    return '\n'.join(lines) + '\n'
+
+
+def _write_batch_records(source, records, output_dir, output_format):
+    text = _format_batch_records(records, output_format)
+    if output_dir is None:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        return
+
+    extension = '.jsonl' if output_format == 'jsonl' else '.md'
+    path = os.path.join(output_dir, _batch_file_name(source) + extension)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(text)
+
+
+async def _process_batch(sources, prmt, model, chunk_size, pages, start_pos,
+                         concurrency, output_dir, output_format, quiet,
+                         extract_workers, summarize_all):
+    asyncio = _lazy_import('asyncio')
+
+    client = create_async_openai_client()
+    semaphore = asyncio.Semaphore(concurrency)
+    load_semaphore = asyncio.Semaphore(concurrency)
+    finished = []
+    failed = []
+
+    async def run(source):
+        try:
+            records = await _batch_source(client, semaphore, load_semaphore,
+                                          source, prmt, model, chunk_size,
+                                          pages, start_pos, extract_workers,
+                                          summarize_all)
+        except Exception as e:
+            records = [{"source": source, "error": str(e)}]
+
+        _write_batch_records(source, records, output_dir, output_format)
+
+        finished.append(source)
+        errors = sum(1 for record in records if 'error' in record)
+        if errors > 0:
+            failed.append(source)
+        if quiet is False:
+            print(f"[{len(finished)}/{len(sources)}] {source}: "
+                  + f"{len(records)} chunks, {errors} errors",
+                  file=sys.stderr)
+
+    try:
+        await asyncio.gather(*(run(source) for source in sources))
+    finally:
+        await client.close()
+
+    return failed
+
+
+def process_batch(sources, prmt, model, chunk_size,
+                  pages=None,
+                  start_pos=0,
+                  concurrency=DEFAULT_BATCH_CONCURRENCY,
+                  output_dir=None,
+                  output_format='md',
+                  quiet=False,
+                  extract_workers=1,
+                  summarize_all=False):
+
+    global download_progress
+
+    asyncio = _lazy_import('asyncio')
+    download_progress = False
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    return asyncio.run(_process_batch(sources, prmt, model, chunk_size,
+                                      pages, start_pos, max(concurrency, 1),
+                                      output_dir, output_format, quiet,
+                                      extract_workers, summarize_all))
+
+
+async def _summarize_all(source, prmt, model, chunk_size, pages, start_pos,
+                         concurrency, extract_workers):
+    asyncio = _lazy_import('asyncio')
+
+    def status(message):
+        print(message, file=sys.stderr)
+
+    try:
+        text = await asyncio.to_thread(load_text,
+                                       source,
+                                       pages,
+                                       extract_workers)
+    except Exception as e:
+        print(e)
+        return
+
+    index = ChunkIndex(_chunk_budget(chunk_size, prmt), text)
+    if index.length == 0:
+        print("Text is empty.")
+        return
+
+    client = create_async_openai_client()
+    try:
+        content = await _map_reduce(client, asyncio.Semaphore(concurrency),
+                                    index, prmt, model, chunk_size,
+                                    start_pos, status)
+    except Exception as e:
+        print(e)
+        return
+    finally:
+        await client.close()
+
+    print(f"({model}):")
+    print(content)
+
+
+def summarize_all(source, prmt, model, chunk_size,
+                  pages=None,
+                  start_pos=0,
+                  concurrency=DEFAULT_BATCH_CONCURRENCY,
+                  extract_workers=1):
+    asyncio = _lazy_import('asyncio')
+    asyncio.run(_summarize_all(source, prmt, model, chunk_size, pages,
+                               start_pos, max(concurrency, 1),
+                               extract_workers))
+
+
 # CLI Interface
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -431,15 +2118,22 @@ if __name__ == "__main__":
                                     + "a file path, or directly as a prompt.")
 
     parser.add_argument('source',
-                        nargs='?',
+                        nargs='*',
                         help="Specify the source for the prompt. "
                              + "Can be a URL, a file path, "
-                             + "or a direct prompt text.")
+                             + "or a direct prompt text. Batch mode "
+                             + "accepts several URLs and file paths.")
+    parser.add_argument('-b',
+                        '--batch',
+                        action='store_true',
+                        help="Summarize every chunk of every source "
+                             + "without waiting for user input.")
     parser.add_argument('-c',
                         '--chunk_size',
-                        type=int,
-                        help="Set the text chunk size (in characters) "
-                             + "for reading operations.",
+                        type=parse_chunk_size,
+                        help="Set the text chunk size for reading "
+                             + "operations, in characters or as a token "
+                             + "budget per request (e.g. \"2000t\").",
                         default=DEFAULT_CHUNK_SIZE)
     parser.add_argument('-d',
                         '--depth',
@@ -447,6 +2141,12 @@ if __name__ == "__main__":
                         help="Define the number of previous interactions "
                              + "to consider in the conversation history.",
                         default=DEFAULT_TALK_QUEUE_SIZE)
+    parser.add_argument('--memory-tokens',
+                        type=int,
+                        help="Token budget for the conversation history. "
+                             + "Older turns are folded into a short "
+                             + "summary.",
+                        default=MEMORY_TOKENS)
     parser.add_argument('-m',
                         '--model',
                         help="Choose the GPT model for text generation. "
@@ -458,25 +2158,175 @@ if __name__ == "__main__":
                         '--prompt',
                         help="Directly provide the text prompt for "
                              + "generation.")
+    parser.add_argument('--corpus',
+                        metavar='QUESTION',
+                        help="Answer a question from passages of all "
+                             + "documents read so far.")
+    parser.add_argument('--summarize-all',
+                        action='store_true',
+                        help="Summarize all chunks in parallel and combine "
+                             + "the summaries into one final answer.")
+    parser.add_argument('-q',
+                        '--quiet',
+                        action='store_true',
+                        help="Suppress status output. Applies only in "
+                             + "batch mode.")
+    parser.add_argument('-s',
+                        '--start_pos',
+                        type=int,
+                        help="Set the start position (in characters) "
+                             + "for reading.",
+                        default=0)
     parser.add_argument('--pages',
                         help="Specify PDF pages to read. Use a "
                              + "comma-separated list and ranges. "
                              + "Example: \"1,3,4-7,11\".")
+    parser.add_argument('--prefetch',
+                        type=int,
+                        help="Summarize up to N upcoming chunks in the "
+                             + "background while reading the current one.",
+                        default=0)
+    parser.add_argument('--list',
+                        help="Read additional batch sources from a file, "
+                             + "one URL or path per line.")
+    parser.add_argument('-o',
+                        '--output',
+                        help="Write batch results to one file per source "
+                             + "in this directory instead of stdout.")
+    parser.add_argument('--format',
+                        choices=['md', 'jsonl'],
+                        help="Batch output format.",
+                        default='md')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        help="Maximum number of concurrent requests "
+                             + "in batch and --summarize-all modes.",
+                        default=DEFAULT_BATCH_CONCURRENCY)
+    parser.add_argument('--cache',
+                        action='store_true',
+                        help="Reuse stored answers for identical requests "
+                             + "(also enabled by GPT_RESPONSE_CACHE=1).")
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help="Skip the response, HTTP and extracted "
+                             + "text caches for this run.")
+    parser.add_argument('--extract-workers',
+                        type=int,
+                        help="Extract PDF text on N worker processes.",
+                        default=1)
+    parser.add_argument('--max-download',
+                        type=int,
+                        help="Refuse downloads larger than this many MB.",
+                        default=MAX_DOWNLOAD_BYTES // (1024 * 1024))
+    parser.add_argument('--retries',
+                        type=int,
+                        help="Retry a request this many times, with "
+                             + "jittered backoff, on connection errors, "
+                             + "rate limits and server errors.",
+                        default=SEND_RETRIES)
+    parser.add_argument('--hedge-after',
+                        type=float,
+                        help="Start a second request when no text has "
+                             + "arrived after this many seconds and use "
+                             + "whichever answers first. 0 disables it.",
+                        default=HEDGE_AFTER_SEC)
+    parser.add_argument('--hedge-model',
+                        help="Model for the second request. "
+                             + "Defaults to the same model.")
+    parser.add_argument('--trace',
+                        help="Append a JSON line with timings for every "
+                             + "request, fetch and extraction to this file.")
+    parser.add_argument('--stream-format',
+                        choices=['text', 'ndjson'],
+                        help="Print replies as text, or as newline-"
+                             + "delimited JSON events (start, delta, end).",
+                        default='text')
+    parser.add_argument('--profile-startup',
+                        action='store_true',
+                        help="Print an import-time breakdown on exit.")
     args = parser.parse_args()
 
+    max_download_bytes = args.max_download * 1024 * 1024
+    memory_tokens = args.memory_tokens
+    stream_format = args.stream_format
+
+    if args.trace is not None:
+        recorder = metrics.Recorder(args.trace)
+        atexit.register(recorder.close)
+
+    if args.profile_startup:
+        atexit.register(print_startup_profile)
+
+    if args.no_cache:
+        init_caches(response=False, http=False, text=False)
+    else:
+        init_caches(response=args.cache or None)
+
     if args.model == '3':
         args.model = GPT35
     elif args.model == '4':
         args.model = GPT4
 
-    if args.source is None:
-        process_talk(args.source, args.model, args.depth)
+    send_retries = max(args.retries, 0)
+    hedge_after = args.hedge_after
+    if args.hedge_model == '3':
+        hedge_model = GPT35
+    elif args.hedge_model == '4':
+        hedge_model = GPT4
+    else:
+        hedge_model = args.hedge_model
+
+    if args.prompt is None:
+        args.prompt = DEFAULT_PROMPT
+
+    if args.batch:
+        sources = list(args.source)
+        if args.list is not None:
+            sources.extend(read_source_list(args.list))
+        if len(sources) == 0:
+            parser.error("batch mode needs at least one source")
+        failed = process_batch(sources,
+                               args.prompt,
+                               args.model,
+                               args.chunk_size,
+                               args.pages,
+                               args.start_pos,
+                               args.concurrency,
+                               args.output,
+                               args.format,
+                               args.quiet,
+                               args.extract_workers,
+                               args.summarize_all)
+        sys.exit(1 if failed else 0)
+
+    if len(args.source) > 1:
+        parser.error("several sources can only be read with --batch")
+
+    if args.corpus is not None:
+        ask_corpus(args.corpus, args.model)
+    elif args.summarize_all:
+        if len(args.source) == 0:
+            parser.error("--summarize-all needs a source")
+        try:
+            summarize_all(args.source[0],
+                          args.prompt,
+                          args.model,
+                          args.chunk_size,
+                          args.pages,
+                          args.start_pos,
+                          args.concurrency,
+                          args.extract_workers)
+        except KeyboardInterrupt:
+            print()
+    elif len(args.source) == 0:
+        process_talk(None, args.model, args.depth)
     else:
-        if args.prompt is None:
-            args.prompt = DEFAULT_PROMPT
-        read_and_process(args.source,
+        read_and_process(args.source[0],
                          args.prompt,
                          args.model,
                          args.chunk_size,
                          args.depth,
-                         args.pages)
+                         args.pages,
+                         args.prefetch,
+                         args.extract_workers,
+                         args.start_pos)
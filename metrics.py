@@ -0,0 +1,82 @@
+import json
+import math
+import threading
+import time
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+class Recorder:
+    def __init__(self, path=None):
+        self.records = []
+        self.lock = threading.Lock()
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'a', encoding='utf-8')
+
+    def record(self, kind, **fields):
+        entry = {"kind": kind, "time": time.time()}
+        entry.update(fields)
+        with self.lock:
+            self.records.append(entry)
+            if self.file is not None:
+                self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self.file.flush()
+        return entry
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def select(self, kind):
+        with self.lock:
+            return [entry for entry in self.records if entry["kind"] == kind]
+
+    def summary(self):
+        lines = []
+
+        requests = self.select("request")
+        if requests:
+            cached = sum(1 for r in requests if r.get("cache") == "hit")
+            errors = sum(1 for r in requests if r.get("error"))
+            lines.append(f"requests: {len(requests)} "
+                         + f"({cached} cached, {errors} errors)")
+            live = [r for r in requests
+                    if r.get("cache") != "hit" and not r.get("error")]
+            for name in ("ttft", "latency"):
+                values = [r[name] for r in live if r.get(name) is not None]
+                if values:
+                    lines.append(f"{name}: p50 {percentile(values, 50):.2f}s"
+                                 + f" p95 {percentile(values, 95):.2f}s")
+            usage = [r for r in live if r.get("usage_prompt_tokens")]
+            if usage:
+                prompt = sum(r["usage_prompt_tokens"] for r in usage)
+                reused = sum(r.get("cached_tokens") or 0 for r in usage)
+                lines.append(f"prompt tokens: {prompt} "
+                             + f"({reused} cached, {reused / prompt:.0%})")
+            streamed = sum(r.get("completion_chars", 0) for r in live)
+            seconds = sum(r.get("latency") or 0 for r in live)
+            if seconds > 0:
+                lines.append(f"throughput: {streamed / seconds:.0f} chars/s, "
+                             + f"{sum(r.get('bytes', 0) for r in live)} "
+                             + "bytes streamed")
+
+        for kind in ("fetch", "extract"):
+            entries = self.select(kind)
+            if entries:
+                values = [e["seconds"] for e in entries]
+                lines.append(f"{kind}: {len(entries)} "
+                             + f"p50 {percentile(values, 50):.2f}s"
+                             + f" p95 {percentile(values, 95):.2f}s")
+
+        if not lines:
+            lines.append("No requests yet.")
+        return "\n".join(lines)
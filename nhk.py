@@ -1,37 +1,52 @@
+import cache
+import extract
 import re
-import requests
+import threading
 import unicodedata
+import web
 
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
 from prompt_toolkit.history import InMemoryHistory
 from prompt_toolkit.shortcuts import prompt
 
 
 KEYS = ['u', 'i', 'o', 'p']
+BASE_URL = "https://www3.nhk.or.jp{href}"
+INDEX_URL = "https://www3.nhk.or.jp/news/catnew.html"
+PREFETCH_WORKERS = 4
 
 history = InMemoryHistory()
 
+# index and article pages, revalidated with conditional requests
+http_cache = None
+
+
+class FetchError(Exception):
+    pass
+
 
 def normalize_unicode(text):
     ascii_text = unicodedata.normalize('NFKC', text)
     return ascii_text
 
 
-def get_content(href):
+def fetch(url):
+    if http_cache is not None:
+        response = http_cache.fetch(url, web.get)
+    else:
+        response = web.get(url)
 
-    base_url = "https://www3.nhk.or.jp{href}"
+    if response.status_code != 200:
+        raise FetchError(
+                f"Failed to retrieve the web page: {response.status_code}")
 
-    response = requests.get(base_url.format(href=href))
+    return response.content.decode('utf-8', 'replace')
 
-    if response.status_code == 200:
-        response.encoding = 'utf-8'
-        html_content = response.text
-    else:
-        print(f"Failed to retrieve the web page: {response.status_code}")
-        html_content = ""
-        return
 
-    soup = BeautifulSoup(html_content, "html.parser")
+def parse_article(html_content):
+    soup = extract.soup(html_content,
+                        SoupStrainer("section", class_="content--body"))
 
     text = ''
 
@@ -43,7 +58,82 @@ def get_content(href):
     text = re.sub("\n\n+", "\n\n", text)
     text = re.sub("\n$", "", text)
 
-    global history
+    return text
+
+
+def parse_index(html_content):
+    soup = extract.soup(html_content, SoupStrainer('dd'))
+
+    links = []
+
+    for dd in soup.find_all('dd'):
+        a_tag = dd.find('a')
+        if not a_tag:
+            continue
+        em_tag = a_tag.find('em', class_='title')
+        if not em_tag:
+            continue
+
+        href = a_tag['href']
+        em_text = em_tag.text
+
+        links.append((em_text, href))
+
+    return links
+
+
+def fetch_article(href):
+    return parse_article(fetch(BASE_URL.format(href=href)))
+
+
+class ArticlePrefetcher:
+    def __init__(self, workers=PREFETCH_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self, hrefs):
+        with self.lock:
+            for href in hrefs:
+                if href not in self.futures:
+                    self.futures[href] = self.executor.submit(fetch_article,
+                                                              href)
+
+    def get(self, href):
+        self.prefetch([href])
+        with self.lock:
+            future = self.futures[href]
+        try:
+            return future.result()
+        except Exception:
+            # fetched again next time
+            with self.lock:
+                if self.futures.get(href) is future:
+                    del self.futures[href]
+            raise
+
+    def retain(self, hrefs):
+        # forget articles that dropped off the index
+        hrefs = set(hrefs)
+        with self.lock:
+            for href in list(self.futures):
+                if href not in hrefs:
+                    self.futures.pop(href).cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_content(href, prefetcher=None):
+
+    try:
+        if prefetcher is not None:
+            text = prefetcher.get(href)
+        else:
+            text = fetch_article(href)
+    except FetchError as e:
+        print(e)
+        return
 
     print("---")
     if len(text) > 0:
@@ -61,82 +151,80 @@ def get_content(href):
 
 def get():
 
-    base_url = "https://www3.nhk.or.jp/news/catnew.html"
-
     global history
 
-    while True:
+    prefetcher = ArticlePrefetcher()
+    index = None
+    links = []
 
-        response = requests.get(base_url)
-
-        if response.status_code == 200:
-            response.encoding = 'utf-8'
-            html_content = response.text
-        else:
-            print(f"Failed to retrieve the web page: {response.status_code}")
-            html_content = ""
-            return
+    try:
+        while True:
 
-        soup = BeautifulSoup(html_content, "html.parser")
+            try:
+                html_content = fetch(INDEX_URL)
+            except FetchError as e:
+                print(e)
+                return
 
-        links = []
+            # an unchanged (304) index is not parsed again
+            if html_content != index:
+                index = html_content
+                links = parse_index(html_content)
+                prefetcher.retain(href for _, href in links)
 
-        for dd in soup.find_all('dd'):
-            a_tag = dd.find('a')
-            if not a_tag:
-                continue
-            em_tag = a_tag.find('em', class_='title')
-            if not em_tag:
-                continue
+            if len(links) == 0:
+                print("No content.")
+                return
 
-            href = a_tag['href']
-            em_text = em_tag.text
+            idx = 0
 
-            links.append((em_text, href))
+            print("---")
 
-        idx = 0
+            while True:
 
-        print("---")
+                reset = False
+                j = 0
+                for i in range(idx, (idx + len(KEYS))):
+                    if i >= len(links):
+                        reset = True
+                        break
+                    print(f"({KEYS[j]}) {links[i][0]}")
+                    j += 1
 
-        while True:
-
-            reset = False
-            j = 0
-            for i in range(idx, (idx + len(KEYS))):
-                if i >= len(links):
-                    reset = True
+                if reset is True:
+                    # back to the top of a revalidated index
                     break
-                print(f"({KEYS[j]}) {links[i][0]}")
-                j += 1
-
-            if reset is True:
-                idx = 0
-                continue
 
-            print("---")
-            try:
-                user_input = prompt("> ", history=history)
-            except EOFError:
-                return
+                # the visible headlines and the next window
+                prefetcher.prefetch(
+                        href for _, href in links[idx:idx + 2 * len(KEYS)])
 
-            if normalize_unicode(user_input) == 'k':
-                return
-            elif user_input == '':
                 print("---")
-                idx += len(KEYS)
-                continue
-            else:
                 try:
-                    k = KEYS.index(user_input)
-                except ValueError:
-                    print(f"Invalid input: {user_input}")
+                    user_input = prompt("> ", history=history)
+                except EOFError:
+                    return
+
+                if normalize_unicode(user_input) == 'k':
+                    return
+                elif user_input == '':
                     print("---")
+                    idx += len(KEYS)
                     continue
-
-            get_content(links[idx + k][1])
-            print("---")
-
+                else:
+                    try:
+                        k = KEYS.index(user_input)
+                    except ValueError:
+                        print(f"Invalid input: {user_input}")
+                        print("---")
+                        continue
+
+                get_content(links[idx + k][1], prefetcher)
+                print("---")
+    finally:
+        prefetcher.close()
 
 
 if __name__ == "__main__":
+    http_cache = cache.HttpCache()
     get()
@@ -0,0 +1,69 @@
+import math
+import re
+
+from collections import Counter, defaultdict
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+CJK_RUN_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff'
+                             r'\uf900-\ufaff\uac00-\ud7af]+')
+TOKEN_PATTERN = re.compile(CJK_RUN_PATTERN.pattern + r'|\w+')
+
+
+def tokenize(text):
+    # CJK has no spaces between words, so runs are split into
+    # overlapping character bigrams
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        word = match.group()
+        if CJK_RUN_PATTERN.match(word):
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def bm25(tf, df, doc_len, avg_len, doc_count):
+    idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len)
+    return idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+
+class BM25Index:
+    def __init__(self):
+        self.postings = defaultdict(list)
+        self.lengths = []
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, text):
+        doc = len(self.lengths)
+        counts = Counter(tokenize(text))
+        for term, tf in counts.items():
+            self.postings[term].append((doc, tf))
+        length = sum(counts.values())
+        self.lengths.append(length)
+        self.total_length += length
+        return doc
+
+    def search(self, query, k=5):
+        if not self.lengths:
+            return []
+
+        avg_len = max(self.total_length / len(self.lengths), 1)
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            for doc, tf in postings:
+                scores[doc] += bm25(tf, len(postings), self.lengths[doc],
+                                    avg_len, len(self.lengths))
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:k]
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_TOKENS_PER_SEC = 200.0
+DEFAULT_FIRST_TOKEN_DELAY_SEC = 0.2
+DEFAULT_REPLY_TOKENS = 60
+WORDS = ("the of and to in is that for it as with was on be by this are "
+         "from at or an have not which but all were when we there can "
+         "been has more if will one would about their what so up out "
+         "time model text page cache chunk request stream latency").split()
+
+
+# Text, HTML and PDF fixtures
+def make_text(paragraphs, seed=0, sentences=6):
+    rng = random.Random(seed)
+    result = []
+    for _ in range(paragraphs):
+        paragraph = []
+        for _ in range(sentences):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+            paragraph.append(' '.join(words).capitalize() + '.')
+        result.append(' '.join(paragraph))
+    return '\n\n'.join(result)
+
+
+def make_html(paragraphs, seed=0):
+    body = ''.join(f"<p>{paragraph}</p>\n"
+                   for paragraph in make_text(paragraphs, seed).split('\n\n'))
+    nav = ''.join(f'<li><a href="/{word}">{word}</a></li>'
+                  for word in WORDS[:20])
+    return ("<!DOCTYPE html>\n<html><head><title>Fixture</title>"
+            "<style>p { margin: 0 }</style>"
+            "<script>var fixture = true;</script></head>\n"
+            f"<body><header><nav><ul>{nav}</ul></nav></header>\n"
+            f"<main><article><h1>Fixture article</h1>\n{body}</article></main>"
+            "\n<footer>Copyright fixture</footer></body></html>\n")
+
+
+def _pdf_escape(text):
+    return (text.replace('\\', '\\\\').replace('(', '\\(')
+            .replace(')', '\\)'))
+
+
+def make_pdf(pages, seed=0, lines_per_page=50, line_chars=90):
+    rng = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for _ in range(pages):
+        lines = []
+        for _ in range(lines_per_page):
+            line = ''
+            while len(line) < line_chars:
+                line += rng.choice(WORDS) + ' '
+            lines.append(line.strip())
+        stream = ("BT /F1 9 Tf 14 TL 40 800 Td "
+                  + ' '.join(f"({_pdf_escape(line)}) '" for line in lines)
+                  + " ET").encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream)
+                       + stream + b"\nendstream")
+        objects.append(("<< /Type /Page /Parent 2 0 R "
+                        "/MediaBox [0 0 612 842] "
+                        "/Resources << /Font << /F1 3 0 R >> >> "
+                        f"/Contents {len(objects)} 0 R >>").encode('ascii'))
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = (f"<< /Type /Pages /Kids [{' '.join(kids)}] "
+                  f"/Count {pages} >>").encode('ascii')
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += (b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, xref))
+    return bytes(out)
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        count = int(query.get('n', 10))
+        seed = int(query.get('seed', 0))
+
+        if url.path.endswith('.html'):
+            body = make_html(count, seed).encode('utf-8')
+            content_type = 'text/html; charset=utf-8'
+        elif url.path.endswith('.pdf'):
+            body = make_pdf(count, seed)
+            content_type = 'application/pdf'
+        elif url.path.endswith('.txt'):
+            body = make_text(count, seed).encode('utf-8')
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+
+        self.server.hits += 1
+        time.sleep(float(query.get('delay', 0)))
+
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', query.get('cache', 'max-age=0'))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# OpenAI-compatible chat completions
+class StubConfig:
+    def __init__(self,
+                 tokens_per_sec=DEFAULT_TOKENS_PER_SEC,
+                 first_token_delay=DEFAULT_FIRST_TOKEN_DELAY_SEC,
+                 reply_tokens=DEFAULT_REPLY_TOKENS,
+                 error_rate=0.0,
+                 error_status=500,
+                 fail_next=0,
+                 seed=None):
+        self.tokens_per_sec = tokens_per_sec
+        self.first_token_delay = first_token_delay
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_next = fail_next
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.prefixes = set()
+
+    def should_fail(self):
+        with self.lock:
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                return True
+        return self.random.random() < self.error_rate
+
+    def cached_tokens(self, messages):
+        # like a provider prompt cache: the longest run of leading
+        # messages that an earlier request started with
+        keys = [hashlib.sha1(json.dumps(messages[:n]).encode('utf-8'))
+                .hexdigest() for n in range(1, len(messages) + 1)]
+        with self.lock:
+            cached = 0
+            for n, key in enumerate(keys[:-1], 1):
+                if key in self.prefixes:
+                    cached = n
+            self.prefixes.update(keys)
+        return _prompt_tokens(messages[:cached])
+
+    def reply(self, messages):
+        prompt = ''.join(m.get('content') or '' for m in messages)
+        tokens = [f"Stub reply to {len(prompt)} chars."]
+        for i in range(1, self.reply_tokens):
+            tokens.append(' ' + WORDS[i % len(WORDS)])
+        return tokens
+
+
+def _prompt_tokens(messages):
+    return (sum(len(m.get('content') or '') for m in messages) + 3) // 4
+
+
+def _usage(messages, completion_tokens, cached_tokens):
+    prompt_tokens = _prompt_tokens(messages)
+    return {"prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+
+class ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        config = self.server.config
+        with config.lock:
+            config.requests.append(request)
+
+        if config.should_fail():
+            self._send_json(config.error_status,
+                            {"error": {"message": "injected error",
+                                       "type": "server_error"}},
+                            {"Retry-After": "0"})
+            return
+
+        model = request.get('model', 'stub')
+        messages = request.get('messages', [])
+        tokens = config.reply(messages)
+        cached = config.cached_tokens(messages)
+        time.sleep(config.first_token_delay)
+
+        if request.get('stream'):
+            self._stream(request, model, messages, tokens, cached, config)
+            return
+
+        time.sleep(len(tokens) / config.tokens_per_sec)
+        self._send_json(200, {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0,
+                         "message": {"role": "assistant",
+                                     "content": ''.join(tokens)},
+                         "finish_reason": "stop"}],
+            "usage": _usage(messages, len(tokens), cached)})
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _event(self, payload):
+        data = b"data: " + json.dumps(payload).encode('utf-8') + b"\n\n"
+        self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, request, model, messages, tokens, cached, config):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        chunk = {"id": "chatcmpl-stub",
+                 "object": "chat.completion.chunk",
+                 "created": int(time.time()),
+                 "model": model}
+        interval = 1 / config.tokens_per_sec
+        try:
+            for i, token in enumerate(tokens):
+                delta = {"content": token}
+                if i == 0:
+                    delta["role"] = "assistant"
+                self._event(dict(chunk, choices=[{"index": 0,
+                                                  "delta": delta,
+                                                  "finish_reason": None}]))
+                time.sleep(interval)
+            self._event(dict(chunk, choices=[{"index": 0,
+                                              "delta": {},
+                                              "finish_reason": "stop"}]))
+            options = request.get('stream_options') or {}
+            if options.get('include_usage'):
+                self._event(dict(chunk, choices=[],
+                                 usage=_usage(messages, len(tokens), cached)))
+            data = b"data: [DONE]\n\n"
+            self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled, e.g. a losing hedged request
+            pass
+
+
+def start_server(handler, port=0, **attributes):
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def start_chat_stub(port=0, config=None):
+    return start_server(ChatHandler, port,
+                        config=config if config is not None else StubConfig())
+
+
+def start_fixture_server(port=0):
+    return start_server(FixtureHandler, port, hits=0)
+
+
+def server_url(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+# CLI Interface
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Local OpenAI-compatible chat stub and document "
+                        + "fixture server for offline testing. Point "
+                        + "gpt.py at it with "
+                        + "OPENAI_BASE_URL=http://127.0.0.1:PORT/v1")
+    parser.add_argument('--port',
+                        type=int,
+                        help="Port of the chat completions stub.",
+                        default=8000)
+    parser.add_argument('--fixture-port',
+                        type=int,
+                        help="Port serving /N.html, /N.pdf and /N.txt "
+                             + "fixtures (?n= paragraphs or pages).",
+                        default=8001)
+    parser.add_argument('--tokens-per-sec',
+                        type=float,
+                        default=DEFAULT_TOKENS_PER_SEC)
+    parser.add_argument('--first-token-delay',
+                        type=float,
+                        help="Seconds before the first token.",
+                        default=DEFAULT_FIRST_TOKEN_DELAY_SEC)
+    parser.add_argument('--reply-tokens',
+                        type=int,
+                        default=DEFAULT_REPLY_TOKENS)
+    parser.add_argument('--error-rate',
+                        type=float,
+                        help="Fraction of requests answered with "
+                             + "--error-status.",
+                        default=0.0)
+    parser.add_argument('--error-status',
+                        type=int,
+                        default=500)
+    args = parser.parse_args()
+
+    chat = start_chat_stub(args.port,
+                           StubConfig(args.tokens_per_sec,
+                                      args.first_token_delay,
+                                      args.reply_tokens,
+                                      args.error_rate,
+                                      args.error_status))
+    fixtures = start_fixture_server(args.fixture_port)
+    print(f"chat stub: {server_url(chat)}/v1")
+    print(f"fixtures: {server_url(fixtures)}/doc.html?n=50 "
+          + f"{server_url(fixtures)}/doc.pdf?n=20")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print()
@@ -1,12 +1,14 @@
-import os
-import requests
+import extract
+import gpt
 import unicodedata
+import web
 
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 from prompt_toolkit.history import InMemoryHistory
 from prompt_toolkit.shortcuts import prompt
 
 KEYS = ['u', 'i', 'o', 'p']
+URL = "https://techcrunch.com"
 
 history = InMemoryHistory()
 
@@ -16,15 +18,31 @@ def normalize_unicode(text):
     return ascii_text
 
 
-def get():
+def parse_index(html_content):
+    soup = extract.soup(html_content,
+                        SoupStrainer("a", class_="post-block__title__link"))
+
+    links = []
+    existing_hrefs = set()
+
+    for a in soup.find_all("a", class_="post-block__title__link"):
+        href = a.get('href')
+        title = a.text.strip()
+        if len(title) > 0:
+            if href not in existing_hrefs:
+                links.append((title, href))
+                existing_hrefs.add(href)
 
-    url = "https://techcrunch.com"
+    return links
+
+
+def get():
 
     global history
 
     while True:
 
-        response = requests.get(url)
+        response = web.get(URL)
 
         if response.status_code == 200:
             response.encoding = 'utf-8'
@@ -34,18 +52,7 @@ def get():
             html_content = ""
             return
 
-        soup = BeautifulSoup(html_content, "html.parser")
-
-        links = []
-        existing_hrefs = set()
-
-        for a in soup.find_all("a", class_="post-block__title__link"):
-            href = a.get('href')
-            title = a.text.strip()
-            if len(title) > 0:
-                if href not in existing_hrefs:
-                    links.append((title, href))
-                    existing_hrefs.add(href)
+        links = parse_index(html_content)
 
         idx = 0
 
@@ -86,11 +93,15 @@ def get():
                     print("---")
                     continue
 
-            command = f"gpt {links[idx + k][1]}"
-            print(command)
-            os.system(command)
+            url = links[idx + k][1]
+            print(url)
+            try:
+                gpt.read_and_process(url)
+            except KeyboardInterrupt:
+                print()
             print("---")
 
 
 if __name__ == "__main__":
+    gpt.init_caches()
     get()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import arxiv
+import cache
+
+LISTING = """<html><body><dl id="articles">
+<dt><a href="/abs/2401.00001" title="Abstract">arXiv:2401.00001</a>
+<a href="/pdf/2401.00001" title="Download PDF">pdf</a></dt>
+<dd><div class="list-title mathjax"><span class="descriptor">Title:</span>
+  First  paper</div>
+<div class="list-subjects"><span class="primary-subject">Artificial
+Intelligence (cs.AI)</span></div></dd>
+<dt><a href="/pdf/2401.00002" title="Download PDF">pdf</a></dt>
+<dd><div class="list-title mathjax">Title: Second paper</div>
+<span class="primary-subject">Machine Learning (cs.LG)</span></dd>
+</dl></body></html>"""
+
+
+class TestParseListing(unittest.TestCase):
+    def test_entries(self):
+        entries = arxiv.parse_listing(LISTING)
+        self.assertEqual([e[0] for e in entries],
+                         ["2401.00001", "2401.00002"])
+        self.assertEqual(entries[0][1], "First paper")
+        self.assertEqual(entries[1][2], "Machine Learning (cs.LG)")
+
+
+class TestFetchListing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        listings = cache.ListingCache(os.path.join(self.tmpdir.name, "l.db"))
+        patcher = mock.patch.object(arxiv, 'listing_cache', listings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_parsed_pages_are_cached(self):
+        response = SimpleNamespace(status_code=200, text=LISTING,
+                                   encoding=None)
+        with mock.patch('web.get', return_value=response) as get:
+            first = arxiv.fetch_listing("cs.AI", 0, 20)
+            second = arxiv.fetch_listing("cs.AI", 0, 20)
+            arxiv.fetch_listing("cs.AI", 20, 20)
+        self.assertEqual(first, second)
+        self.assertEqual(get.call_count, 2)
+        self.assertIn("skip=20&show=20", get.call_args[0][0])
+
+    def test_error_is_raised(self):
+        response = SimpleNamespace(status_code=503, text="", encoding=None)
+        with mock.patch('web.get', return_value=response):
+            with self.assertRaises(arxiv.ListingError):
+                arxiv.fetch_listing("cs.AI", 0, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
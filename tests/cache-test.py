@@ -0,0 +1,175 @@
+import hashlib
+import io
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from cache import (HttpCache, ListingCache, LRUStore, ResponseCache,
+                   TextCache, parse_cache_control)
+
+
+class TestLRUStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "store.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_and_put(self):
+        store = LRUStore(self.path, 100)
+        self.assertIsNone(store.get("a"))
+        store.put("a", b"value")
+        self.assertEqual(store.get("a"), b"value")
+
+    def test_evicts_least_recently_used(self):
+        store = LRUStore(self.path, 10)
+        store.put("a", b"1234")
+        store.put("b", b"1234")
+        store.get("a")
+        store.put("c", b"1234")
+        self.assertEqual(store.get("a"), b"1234")
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.get("c"), b"1234")
+
+    def test_skips_oversized_values(self):
+        store = LRUStore(self.path, 4)
+        store.put("a", b"12345")
+        self.assertIsNone(store.get("a"))
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_key_depends_on_model_and_messages(self):
+        messages = [{"role": "user", "content": "hi"}]
+        key = ResponseCache.key("m1", messages)
+        self.assertEqual(key, ResponseCache.key("m1", list(messages)))
+        self.assertNotEqual(key, ResponseCache.key("m2", messages))
+        self.assertNotEqual(
+                key,
+                ResponseCache.key("m1", [{"role": "user", "content": "ho"}]))
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            responses = ResponseCache(os.path.join(tmpdir, "r.db"))
+            responses.put("k", "こんにちは")
+            self.assertEqual(responses.get("k"), "こんにちは")
+
+
+class TestTextCache(unittest.TestCase):
+    def test_key_depends_on_content_and_pages(self):
+        key = TextCache.key('abc', 'application/pdf', '1-3')
+        self.assertEqual(key, TextCache.key('abc', 'application/pdf', '1-3'))
+        self.assertNotEqual(key, TextCache.key('abc', 'application/pdf'))
+        self.assertNotEqual(key, TextCache.key('abd', 'application/pdf', '1-3'))
+        self.assertNotEqual(key, TextCache.key('abc', 'text/html', '1-3'))
+
+    def test_key_depends_on_extractor(self):
+        key = TextCache.key('abc', 'text/html', None, 'lxml-2')
+        self.assertNotEqual(key, TextCache.key('abc', 'text/html'))
+        self.assertNotEqual(key, TextCache.key('abc', 'text/html', None,
+                                               'html.parser-2'))
+
+    def test_round_trip_is_compressed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            texts = TextCache(os.path.join(tmpdir, "t.db"))
+            text = "page text " * 1000
+            texts.put("k", text)
+            self.assertEqual(texts.get("k"), text)
+            self.assertLess(len(texts.store.get("k")), len(text))
+
+
+class TestListingCache(unittest.TestCase):
+    def test_entries_expire(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            listings = ListingCache(os.path.join(tmpdir, "l.db"), ttl=60)
+            self.assertIsNone(listings.get("cs.AI:0:20"))
+            listings.put("cs.AI:0:20", [["2401.00001", "Title", "cs.AI"]])
+            self.assertEqual(listings.get("cs.AI:0:20"),
+                             [["2401.00001", "Title", "cs.AI"]])
+            with mock.patch('time.time', return_value=time.time() + 61):
+                self.assertIsNone(listings.get("cs.AI:0:20"))
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, content=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+
+
+class TestHttpCache(unittest.TestCase):
+    url = "https://example.com/paper.pdf"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = HttpCache(os.path.join(self.tmpdir.name, "http.db"))
+        self.requests = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get(self, *responses):
+        responses = list(responses)
+
+        def fake_get(url, headers=None, **kwargs):
+            self.requests.append(headers)
+            return responses.pop(0)
+        return fake_get
+
+    def test_parse_cache_control(self):
+        self.assertEqual(parse_cache_control('public, max-age=60'),
+                         {'public': '', 'max-age': '60'})
+
+    def test_fresh_entry_skips_network(self):
+        get = self.get(FakeResponse(200, {'Cache-Control': 'max-age=60'},
+                                    b'body'))
+        self.cache.fetch(self.url, get)
+        response = self.cache.fetch(self.url, get)
+        self.assertEqual(response.content, b'body')
+        self.assertEqual(len(self.requests), 1)
+
+    def test_revalidates_with_etag(self):
+        get = self.get(FakeResponse(200, {'ETag': '"v1"'}, b'body'),
+                       FakeResponse(304))
+        self.cache.fetch(self.url, get)
+        response = self.cache.fetch(self.url, get)
+        self.assertEqual(self.requests[1], {'If-None-Match': '"v1"'})
+        self.assertTrue(response.not_modified)
+        self.assertEqual(response.content, b'body')
+
+    def test_no_store(self):
+        get = self.get(FakeResponse(200, {'Cache-Control': 'no-store',
+                                          'ETag': '"v1"'}, b'body'),
+                       FakeResponse(200, {}, b'body'))
+        self.cache.fetch(self.url, get)
+        self.cache.fetch(self.url, get)
+        self.assertEqual(self.requests[1], {})
+
+    def test_bodies_are_files(self):
+        body = io.BytesIO(b'x' * 200000)
+        self.cache.save(self.url, {'ETag': '"v1"'}, body)
+        entry = self.cache.lookup(self.url)
+        with open(entry['path'], 'rb') as file:
+            self.assertEqual(file.read(), b'x' * 200000)
+        self.assertEqual(entry['digest'],
+                         hashlib.sha256(b'x' * 200000).hexdigest())
+        # only the headers are kept in the database
+        self.assertLess(len(self.cache.store.get(self.url)), 200)
+
+    def test_eviction_removes_bodies(self):
+        http = HttpCache(os.path.join(self.tmpdir.name, "small.db"), 1000)
+        http.save("https://example.com/a", {'ETag': '"a"'}, b'a' * 600)
+        first = http.lookup("https://example.com/a")['path']
+        http.save("https://example.com/b", {'ETag': '"b"'}, b'b' * 600)
+        self.assertIsNone(http.lookup("https://example.com/a"))
+        self.assertFalse(os.path.exists(first))
+        self.assertIsNotNone(http.lookup("https://example.com/b"))
+        http.save("https://example.com/c", {'ETag': '"c"'}, b'c' * 2000)
+        self.assertIsNone(http.lookup("https://example.com/c"))
+        self.assertEqual(len(os.listdir(http.body_dir)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
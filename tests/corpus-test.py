@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from corpus import Corpus
+
+
+class TestCorpus(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.corpus = Corpus(os.path.join(self.tmpdir.name, "corpus.db"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add(self, source, *passages):
+        text = ''.join(passages)
+        starts = [sum(len(p) for p in passages[:i])
+                  for i in range(len(passages))]
+        return self.corpus.add(source, text, list(zip(starts, passages)))
+
+    def test_search_across_documents(self):
+        self.add("a", "Transformers use attention. ", "Cats purr loudly. ")
+        self.add("b", "Attention is all you need for transformers.")
+        self.add("c", "東京の天気は晴れです。")
+        hits = self.corpus.search("attention", 5)
+        self.assertEqual(sorted(h["source"] for h in hits), ["a", "b"])
+        self.assertEqual(self.corpus.search("need attention")[0]["source"],
+                         "b")
+        self.assertEqual(self.corpus.search("purr")[0]["start"], 28)
+        self.assertEqual(self.corpus.search("天気", 1)[0]["source"], "c")
+        self.assertEqual(self.corpus.search("zebra"), [])
+
+    def test_same_document_is_skipped(self):
+        self.assertTrue(self.add("a", "hello world"))
+        self.assertFalse(self.add("a", "hello world"))
+        self.assertEqual(self.corpus.stats()["documents"], 1)
+
+    def test_changed_document_replaces_old_passages(self):
+        self.add("a", "old words here")
+        self.add("a", "new words here")
+        self.assertEqual(self.corpus.search("old"), [])
+        self.assertEqual(self.corpus.search("new")[0]["text"],
+                         "new words here")
+
+    def test_segments_are_merged(self):
+        with mock.patch('corpus.MERGE_FACTOR', 2):
+            self.add("a", "alpha shared")
+            self.add("b", "beta shared")
+            self.assertEqual(self.corpus.stats()["segments"], 1)
+            self.add("a", "gamma shared")
+            self.add("c", "delta shared")
+            # two level-1 segments merge into one level-2 segment
+            self.assertEqual(self.corpus.stats()["segments"], 1)
+        hits = self.corpus.search("shared", 10)
+        self.assertEqual(sorted(h["source"] for h in hits), ["a", "b", "c"])
+        rows = self.corpus.db.execute(
+                "SELECT data FROM postings WHERE term = 'alpha'").fetchall()
+        self.assertEqual(rows, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
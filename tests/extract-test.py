@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+
+import extract
+
+from extract import HTMLTextExtractor, LxmlTextExtractor
+
+
+def run(backend, html, size=None):
+    parser = backend()
+    size = size or len(html)
+    text = ''
+    for i in range(0, len(html), size):
+        parser.feed(html[i:i + size])
+        text += parser.pop_text()
+    parser.close()
+    return text + parser.pop_text()
+
+
+class TestHTMLTextExtractor(unittest.TestCase):
+    backend = HTMLTextExtractor
+    html = ("<html><head><script>var x = '<p>';</script></head>"
+            "<body><h1>Title</h1><p>Fish &amp; chips.</p>"
+            "<!-- note --><p>Second  paragraph.</p></body></html>")
+    page = ("<html><body><header><a href='/'>Home</a></header>"
+            "<nav><ul><li>News</li><li>Sports</li></ul></nav>"
+            "<p>Breadcrumb</p>"
+            "<article><header><h1>Headline</h1></header>"
+            "<p>Body text.</p><aside>Related</aside>"
+            "<form><button>Share</button></form></article>"
+            "<footer>Copyright</footer></body></html>")
+
+    def test_extracts_visible_text(self):
+        self.assertEqual(run(self.backend, self.html),
+                         "Title Fish & chips. Second  paragraph.")
+
+    def test_incremental_feed(self):
+        for size in (1, 5, 13):
+            self.assertEqual(run(self.backend, self.html, size),
+                             run(self.backend, self.html))
+
+    def test_keeps_main_content_only(self):
+        self.assertEqual(run(self.backend, self.page), "Headline Body text.")
+        for size in (1, 7):
+            self.assertEqual(run(self.backend, self.page, size),
+                             "Headline Body text.")
+
+    def test_ignores_articles_in_boilerplate(self):
+        body = "<div><p>Real content here.</p></div>"
+        for card in ("<aside><article>Teaser</article></aside>",
+                     "<nav><article>Teaser</article></nav>"):
+            self.assertEqual(run(self.backend, card + body),
+                             "Real content here.")
+        self.assertEqual(run(self.backend,
+                             body + "<footer><article>Card</article>"
+                             "</footer><p>After</p>"),
+                         "Real content here. After")
+        self.assertEqual(run(self.backend,
+                             "<aside><article>Teaser</article></aside>"
+                             + self.page),
+                         "Headline Body text.")
+
+    def test_releases_text_without_main(self):
+        with mock.patch.object(extract, 'MAIN_SEARCH_CHARS', 100):
+            parser = self.backend()
+            parser.feed("<p>" + "word " * 100 + "</p>")
+            # streamed before close once nothing looks like main content
+            self.assertTrue(parser.pop_text().startswith("word"))
+            parser.feed("<p>Tail</p>")
+            parser.close()
+            self.assertEqual(parser.pop_text(), " Tail")
+
+
+@unittest.skipUnless(extract._load_lxml(), "lxml is not installed")
+class TestLxmlTextExtractor(TestHTMLTextExtractor):
+    backend = LxmlTextExtractor
+
+
+class TestCreateTextExtractor(unittest.TestCase):
+    def test_configured_parser(self):
+        with mock.patch.object(extract, 'HTML_PARSER', 'html.parser'):
+            self.assertIsInstance(extract.create_text_extractor(),
+                                  HTMLTextExtractor)
+
+    def test_soup_parse_only(self):
+        from bs4 import SoupStrainer
+
+        with mock.patch.object(extract, 'HTML_PARSER', 'html.parser'):
+            soup = extract.soup("<div><a class='x'>One</a><p>Skip</p>"
+                                "<a>Two</a></div>",
+                                SoupStrainer('a', class_='x'))
+        self.assertEqual(soup.get_text(), "One")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,24 @@
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
-from gpt import expand_page_range
+from types import SimpleNamespace
+from unittest import mock
+
+import cache
+import extract
+import gpt
+import metrics
+import stub
+
+from gpt import (ChunkBudget, ChunkIndex, ChunkPrefetcher, ChunkRetriever,
+                 ConversationMemory, StreamRenderer, estimate_tokens,
+                 expand_page_range, gist, group_for_context, parse_chunk_size,
+                 process_batch, read_source_list)
 
 class TestExpandPageRange(unittest.TestCase):
     def test_expand_single_number(self):
@@ -25,6 +44,669 @@ class TestExpandPageRange(unittest.TestCase):
             # If your function supports negatives, adjust this test accordingly.
             expand_page_range("-3--1")
 
+class TestParseChunkSize(unittest.TestCase):
+    def test_characters(self):
+        self.assertEqual(parse_chunk_size("3000"), ChunkBudget(3000, 'chars'))
+        self.assertEqual(parse_chunk_size(3000), ChunkBudget(3000, 'chars'))
+
+    def test_tokens(self):
+        self.assertEqual(parse_chunk_size("2000t"),
+                         ChunkBudget(2000, 'tokens'))
+        self.assertEqual(parse_chunk_size("2000 tokens"),
+                         ChunkBudget(2000, 'tokens'))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_chunk_size("2000x")
+
+
+class TestChunkIndex(unittest.TestCase):
+    text = "First sentence here. Second one follows! " * 20
+
+    def test_snaps_to_sentences(self):
+        index = ChunkIndex(100, self.text)
+        self.assertEqual(index.text, self.text)
+        for chunk in index.chunks[:-1]:
+            self.assertTrue(chunk.rstrip().endswith(('.', '!')))
+            self.assertLessEqual(len(chunk), 100)
+
+    def test_token_budget(self):
+        text = "日本語の文章です。" * 100
+        index = ChunkIndex("50t", text)
+        self.assertEqual(index.text, text)
+        for chunk in index.chunks:
+            self.assertLessEqual(estimate_tokens(chunk), 50)
+
+    def test_locate(self):
+        index = ChunkIndex(100, self.text)
+        self.assertEqual(index.locate(0), 0)
+        self.assertEqual(index.locate(index.offsets[2]), 2)
+        self.assertEqual(index.locate(index.offsets[2] + 1), 2)
+        self.assertEqual(index.locate(10 ** 9), len(index) - 1)
+
+    def test_incremental_feed(self):
+        index = ChunkIndex(100)
+        for i in range(0, len(self.text), 37):
+            index.feed(self.text[i:i + 37])
+        index.close()
+        self.assertEqual(index.chunks, ChunkIndex(100, self.text).chunks)
+
+    def test_long_text_in_one_piece(self):
+        index = ChunkIndex(100)
+        index.feed(self.text * 50)
+        # only the uncut tail is kept, not the whole text
+        self.assertLessEqual(len(index.pending), 100)
+        self.assertEqual(index.start, 0)
+        index.close()
+        self.assertEqual(''.join(index.chunks), self.text * 50)
+        self.assertEqual(index.length, len(self.text) * 50)
+
+    def test_consume_in_background(self):
+        index = ChunkIndex(100)
+        index.consume(self.text[i:i + 37]
+                      for i in range(0, len(self.text), 37))
+        index.ensure(0)
+        self.assertGreater(len(index), 0)
+        index.thread.join()
+        self.assertTrue(index.complete)
+        self.assertEqual(index.text, self.text)
+
+    def test_cancel_stops_download(self):
+        blocks = []
+
+        class EndlessResponse:
+            status_code = 200
+            url = "https://example.com/big.pdf"
+            headers = {'Content-Type': 'application/pdf'}
+            closed = False
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self.closed = True
+
+            def raise_for_status(self):
+                pass
+
+            def iter_content(self, size):
+                while True:
+                    blocks.append(size)
+                    if len(blocks) == 3:
+                        index.cancel(wait=False)
+                    yield b'x' * size
+
+        response = EndlessResponse()
+        index = ChunkIndex(100)
+        with mock.patch('web.get', return_value=response), \
+                mock.patch('gpt.http_cache', None):
+            index.consume(gpt.iter_url_text(response.url,
+                                            stopped=index.stopped))
+            index.thread.join(5)
+        self.assertFalse(index.thread.is_alive())
+        self.assertTrue(response.closed)
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual(index.length, 0)
+
+
+class TestUrlCache(unittest.TestCase):
+    def test_cached_body_is_read_from_file(self):
+        body = b'line of text\n' * 20000
+        url = "https://example.com/notes.txt"
+
+        class Response:
+            status_code = 200
+            headers = {'Content-Type': 'text/plain',
+                       'Cache-Control': 'max-age=60'}
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def raise_for_status(self):
+                pass
+
+            def iter_content(self, size):
+                for i in range(0, len(body), size):
+                    yield body[i:i + size]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            http = cache.HttpCache(os.path.join(tmpdir, "http.db"))
+            with mock.patch('web.get', return_value=Response()) as get, \
+                    mock.patch('gpt.http_cache', http), \
+                    mock.patch('gpt.text_cache', None), \
+                    mock.patch('gpt.recorder', metrics.Recorder()), \
+                    mock.patch('sys.stderr', io.StringIO()):
+                first = ''.join(gpt.iter_url_text(url))
+                pieces = list(gpt.iter_url_text(url))
+            self.assertEqual(get.call_count, 1)
+        self.assertEqual(first, body.decode('utf-8'))
+        self.assertEqual(''.join(pieces), first)
+        # streamed from the body file in blocks
+        self.assertGreater(len(pieces), 1)
+
+
+def fake_complete(message, model, use_cache, instructions):
+    return f"{instructions}\n\n{message}"
+
+
+class TestChunkPrefetcher(unittest.TestCase):
+    def test_schedules_upcoming_chunks(self):
+        with mock.patch('gpt._complete', side_effect=fake_complete):
+            prefetcher = ChunkPrefetcher(2)
+            prefetcher.schedule(ChunkIndex(2, "aabbccdd"), 0, "P", "model")
+            self.assertEqual(sorted(prefetcher.futures), [2, 4])
+            prefetcher.executor.shutdown(wait=True)
+            self.assertEqual(prefetcher.take(2), "P\n\nbb")
+            self.assertIsNone(prefetcher.take(2))
+            prefetcher.shutdown()
+
+    def test_reset_discards_work(self):
+        with mock.patch('gpt._complete', side_effect=fake_complete):
+            prefetcher = ChunkPrefetcher(1)
+            prefetcher.schedule(ChunkIndex(2, "aabb"), 0, "P", "model")
+            prefetcher.reset()
+            self.assertIsNone(prefetcher.take(2))
+            prefetcher.shutdown()
+
+    def test_disabled(self):
+        prefetcher = ChunkPrefetcher(0)
+        prefetcher.schedule(ChunkIndex(2, "aabb"), 0, "P", "model")
+        self.assertIsNone(prefetcher.take(2))
+        prefetcher.shutdown()
+
+
+class TestChunkRetriever(unittest.TestCase):
+    def test_indexes_new_chunks(self):
+        index = ChunkIndex(20)
+        index.feed("Apples are sweet.\n\nBananas are yellow.\n\n")
+        retriever = ChunkRetriever(index)
+        hits = retriever.search("bananas")
+        self.assertEqual(len(hits), 1)
+        self.assertIn("Bananas", index[hits[0]])
+        index.feed("Cherries, sweet.")
+        index.close()
+        hits = retriever.search("sweet", 5)
+        self.assertEqual(len(hits), 2)
+        self.assertIn("Cherries", index[hits[1]])
+        retriever.reset()
+        self.assertEqual(len(retriever.bm25), 0)
+
+
+class FakeTTY(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def isatty(self):
+        return True
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+class TestParallelPdf(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmpdir.name, "doc.pdf")
+        with open(cls.path, 'wb') as file:
+            file.write(stub.make_pdf(40, lines_per_page=5))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def sequential(self, pages=None):
+        with open(self.path, 'rb') as file:
+            return list(gpt.iter_pdf_pages(file, pages))
+
+    def test_matches_sequential_order(self):
+        # batches may finish in any order but must come back in page order
+        for pages in (None, "3-30,35,2"):
+            self.assertEqual(
+                    list(gpt.iter_pdf_pages_parallel(self.path, pages, 3)),
+                    self.sequential(pages))
+
+    def test_pages_out_of_range_are_skipped(self):
+        self.assertEqual(
+                list(gpt.iter_pdf_pages_parallel(self.path, "39-45", 2)),
+                self.sequential("39-40"))
+
+    def test_close_early_stops_workers(self):
+        import multiprocessing
+
+        pieces = gpt.iter_pdf_pages_parallel(self.path, None, 2)
+        first = [next(pieces), next(pieces)]
+        pieces.close()
+        self.assertEqual(first, self.sequential("1-2"))
+        for _ in range(100):
+            if not multiprocessing.active_children():
+                break
+            threading.Event().wait(0.05)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+class TestTextCacheKey(unittest.TestCase):
+    def test_html_key_names_the_extractor(self):
+        with mock.patch('gpt.text_cache', cache.TextCache), \
+                mock.patch('extract.HTML_PARSER', 'html.parser'):
+            html = gpt._text_cache_key('text/html; charset=utf-8', 'd', None)
+            pdf = gpt._text_cache_key('application/pdf', 'd', None)
+        self.assertTrue(html.endswith(":html.parser-"
+                                      + f"{extract.EXTRACTOR_VERSION}"))
+        self.assertEqual(pdf, "d:application/pdf:")
+
+
+class TestStartupProfile(unittest.TestCase):
+    def test_includes_module_imports(self):
+        with mock.patch('sys.stderr', io.StringIO()) as err:
+            gpt.print_startup_profile()
+        lines = err.getvalue().splitlines()
+        self.assertIn("module imports", lines[2])
+        self.assertIn("total since startup", lines[-1])
+
+
+class TestProcessChunks(unittest.TestCase):
+    text = "First sentence here. Second one follows! " * 20
+
+    def test_goto_waits_for_loading_text(self):
+        index = ChunkIndex(100)
+        index.feed(self.text[:200])
+        timer = threading.Timer(0.1, lambda: (index.feed(self.text[200:]),
+                                              index.close()))
+        timer.start()
+        output = io.StringIO()
+        with mock.patch('gpt.prompt', side_effect=["@goto 600", "k"]), \
+                mock.patch('gpt.file_history', return_value=None), \
+                mock.patch('gpt._send', return_value="s"), \
+                mock.patch('sys.stdout', output):
+            gpt.process_chunks(index, "P", "model", 100, 8, 0)
+        timer.join()
+        target = index.offsets[index.locate(600)]
+        self.assertGreater(target, 500)
+        self.assertIn(f"going to {target}", output.getvalue())
+
+    def test_model_prefix_applies_to_ask(self):
+        index = ChunkIndex(100, self.text)
+        with mock.patch('gpt.prompt', side_effect=["@4@ask why?", "k"]), \
+                mock.patch('gpt.file_history', return_value=None), \
+                mock.patch('gpt._send', return_value="s") as send, \
+                mock.patch('gpt._ask') as ask, \
+                mock.patch('sys.stdout', io.StringIO()):
+            gpt.process_chunks(index, "P", "model", 100, 8, 0)
+        self.assertEqual(ask.call_args[0][2:4], ("why?", gpt.GPT4))
+        # only the chunk summary was sent, not a side conversation
+        self.assertEqual(send.call_count, 1)
+
+
+class TestStreamRenderer(unittest.TestCase):
+    def test_pipe_writes_in_blocks(self):
+        out = FakeTTY()
+        out.isatty = lambda: False
+        renderer = StreamRenderer("model", quiet=True, out=out)
+        renderer.begin()
+        for text in ["a", "b", None, "c"] * 50:
+            renderer.feed(text)
+        self.assertEqual(renderer.finish(), "abc" * 50)
+        self.assertEqual(out.getvalue(), "abc" * 50)
+        # the first delta, then one block at the end
+        self.assertEqual(out.writes, 2)
+
+    def test_tty_flushes_on_size(self):
+        out = FakeTTY()
+        renderer = StreamRenderer("model", quiet=True, out=out)
+        with mock.patch('gpt.time.perf_counter', return_value=1.0), \
+                mock.patch('gpt.RENDER_FLUSH_SEC', 60):
+            for _ in range(300):
+                renderer.feed("x")
+        self.assertEqual(out.writes, 2)
+        renderer.finish()
+        self.assertEqual(out.getvalue(), "x" * 300)
+
+    def test_tty_flushes_after_pause(self):
+        out = FakeTTY()
+        renderer = StreamRenderer("model", quiet=True, out=out)
+        with mock.patch('gpt.RENDER_FLUSH_SEC', 0.01):
+            for text in ["Hello", " world,", " this is"]:
+                renderer.feed(text)
+            # nothing more arrives, but the buffered text is shown
+            for _ in range(100):
+                if out.getvalue() == "Hello world, this is":
+                    break
+                time.sleep(0.01)
+        self.assertEqual(out.getvalue(), "Hello world, this is")
+        renderer.finish()
+        self.assertEqual(out.getvalue(), "Hello world, this is")
+
+    def test_replay_has_no_timing(self):
+        with mock.patch('sys.stdout', io.StringIO()) as out, \
+                mock.patch('sys.stderr', io.StringIO()) as err:
+            self.assertEqual(gpt._render(["answer"], "model", timed=False),
+                             "answer")
+        self.assertIn("answer", out.getvalue())
+        self.assertEqual(err.getvalue(), "")
+
+        out = io.StringIO()
+        renderer = StreamRenderer("model", out=out, events=True, timed=False)
+        renderer.feed("answer")
+        renderer.finish()
+        end = json.loads(out.getvalue().splitlines()[-1])
+        self.assertEqual(end, {"event": "end", "model": "model", "chars": 6})
+
+    def test_ndjson_events(self):
+        out = io.StringIO()
+        renderer = StreamRenderer("model", out=out, events=True)
+        renderer.begin()
+        renderer.feed("hi")
+        renderer.feed(" there")
+        self.assertEqual(renderer.finish(), "hi there")
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([e['event'] for e in events],
+                         ["start", "delta", "delta", "end"])
+        self.assertEqual(events[-1]['chars'], 8)
+        self.assertIsNotNone(events[-1]['ttft'])
+
+
+class TestAddToCorpusLater(unittest.TestCase):
+    def index(self, pieces, cancel=False):
+        index = ChunkIndex(4)
+        with mock.patch('gpt.doc_corpus', mock.Mock()), \
+                mock.patch('gpt.add_to_corpus') as add:
+            thread = gpt.add_to_corpus_later("src", index)
+            if cancel:
+                index.cancel()
+            index.consume(iter(pieces))
+            thread.join(5)
+        return add
+
+    def test_after_the_chunker_closes(self):
+        add = self.index(["one ", "two"])
+        add.assert_called_once_with("src", "one two")
+
+    def test_skips_cancelled_reads(self):
+        add = self.index(["one ", "two"], cancel=True)
+        add.assert_not_called()
+
+
+class TestSendTrace(unittest.TestCase):
+    def test_records_errors(self):
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = RuntimeError("down")
+        recorder = metrics.Recorder()
+        with mock.patch('gpt.get_openai_client', return_value=client), \
+                mock.patch('gpt.recorder', recorder), \
+                mock.patch('builtins.print'):
+            self.assertEqual(gpt._send("hello", None, "model"), "")
+        entry = recorder.select("request")[0]
+        self.assertEqual(entry["error"], "down")
+        self.assertEqual(entry["model"], "model")
+        self.assertEqual(entry["prompt_chars"], 5)
+
+    def test_ndjson_errors_are_events(self):
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = RuntimeError("down")
+        output = io.StringIO()
+        with mock.patch('gpt.get_openai_client', return_value=client), \
+                mock.patch('gpt.recorder', metrics.Recorder()), \
+                mock.patch('gpt.stream_format', 'ndjson'), \
+                mock.patch('sys.stdout', output):
+            gpt.process_talk("hello", "model", 8)
+        events = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(events, [{"event": "error", "model": "model",
+                                   "message": "down"}])
+
+
+class FakeStream:
+    def __init__(self, texts, delay=None):
+        self.texts = texts
+        self.delay = delay
+        self.closed = False
+
+    def __iter__(self):
+        if self.delay is not None:
+            self.delay.wait(5)
+        for text in self.texts:
+            delta = SimpleNamespace(content=text)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    def close(self):
+        self.closed = True
+
+
+class Overloaded(Exception):
+    status_code = 503
+
+
+class TestRetryAndHedge(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        patches = [mock.patch('gpt.get_openai_client',
+                              return_value=self.client),
+                   mock.patch('gpt.time.sleep'),
+                   mock.patch('gpt.recorder', metrics.Recorder()),
+                   mock.patch('sys.stderr', io.StringIO()),
+                   mock.patch('sys.stdout', io.StringIO())]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_retries_transient_errors(self):
+        self.client.chat.completions.create.side_effect = [
+                Overloaded(), FakeStream([None, "he", "llo"])]
+        self.assertEqual(gpt._send("q", None, "model"), "hello")
+        entry = gpt.recorder.select("request")[0]
+        self.assertEqual(entry["retries"], 1)
+
+    def test_gives_up_on_other_errors(self):
+        self.client.chat.completions.create.side_effect = [
+                RuntimeError("bad"), FakeStream(["x"])]
+        self.assertEqual(gpt._send("q", None, "model"), "")
+        self.assertEqual(self.client.chat.completions.create.call_count, 1)
+
+    def test_empty_reply_is_not_remembered(self):
+        self.client.chat.completions.create.return_value = FakeStream([None])
+        memory = gpt.ConversationMemory(1000)
+        self.assertEqual(gpt._send("q", memory, "model"), "")
+        self.assertEqual(memory.get_size(), 0)
+        self.assertEqual(gpt.recorder.select("request")[0]["error"],
+                         "empty reply")
+
+    def test_hedge_uses_first_to_stream(self):
+        release = threading.Event()
+        slow = FakeStream(["slow"], delay=release)
+        fast = FakeStream(["fast"])
+
+        def create(model, **kwargs):
+            return slow if model == "model" else fast
+
+        self.client.chat.completions.create.side_effect = create
+        with mock.patch('gpt.hedge_after', 0.05), \
+                mock.patch('gpt.hedge_model', "other"):
+            self.assertEqual(gpt._send("q", None, "model"), "fast")
+            release.set()
+        for _ in range(100):
+            if slow.closed:
+                break
+            threading.Event().wait(0.01)
+        self.assertTrue(slow.closed)
+        entry = gpt.recorder.select("request")[0]
+        self.assertTrue(entry["hedged"])
+        self.assertEqual(entry["answered_by"], "other")
+
+
+class TestConversationMemory(unittest.TestCase):
+    def exchange(self, memory, n, size=40):
+        memory.append({"role": "user", "content": f"q{n}. " + "x" * size})
+        memory.append({"role": "assistant", "content": f"a{n}. " + "y" * size})
+
+    def test_within_budget(self):
+        memory = ConversationMemory(1000)
+        self.exchange(memory, 1)
+        self.assertEqual(memory.get_size(), 2)
+        self.assertEqual(memory.get_array(), memory.messages)
+
+    def test_old_turns_are_summarized(self):
+        memory = ConversationMemory(80)
+        for n in range(10):
+            self.exchange(memory, n, 20)
+        self.assertLess(memory.get_size(), 20)
+        self.assertLessEqual(memory.tokens + memory.summary_tokens, 80)
+        self.assertLessEqual(memory.summary_tokens, 20)
+        evicted = 9 - memory.get_size() // 2
+        history = memory.get_array()
+        self.assertEqual(history[0]['role'], "system")
+        self.assertIn(f"q{evicted}.", history[0]['content'])
+        self.assertEqual(history[1:], memory.messages)
+
+    def test_message_limit(self):
+        memory = ConversationMemory(10000, max_messages=4)
+        for n in range(3):
+            self.exchange(memory, n)
+        self.assertEqual(memory.get_size(), 4)
+        self.assertIn("q0.", memory.get_array()[0]['content'])
+
+    def test_clear(self):
+        memory = ConversationMemory(40)
+        for n in range(3):
+            self.exchange(memory, n)
+        memory.clear()
+        self.assertEqual(memory.get_array(), [])
+        self.assertEqual(memory.tokens + memory.summary_tokens, 0)
+
+    def test_gist(self):
+        self.assertEqual(gist("short  text\n"), "short text")
+        self.assertEqual(gist("One. " + "b" * 10, 8), "One. ...")
+
+
+async def fake_complete_async(client, semaphore, message, model,
+                              instructions=None):
+    if "bad" in message:
+        raise RuntimeError("boom")
+    return f"{instructions}\n\n{message}".upper()
+
+
+class TestBatch(unittest.TestCase):
+    def test_read_source_list(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sources.txt")
+            with open(path, 'w') as file:
+                file.write("# comment\nhttps://a\n\n  b.txt \n")
+            self.assertEqual(read_source_list(path), ["https://a", "b.txt"])
+
+    def test_writes_one_result_per_source(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sources = []
+            for name, text in (("a.txt", "aa.bb."), ("b.txt", "bad.")):
+                sources.append(os.path.join(tmp, name))
+                with open(sources[-1], 'w') as file:
+                    file.write(text)
+            out = os.path.join(tmp, "out")
+            with mock.patch('gpt._complete_async', new=fake_complete_async), \
+                    mock.patch('gpt.create_async_openai_client',
+                               return_value=mock.AsyncMock()):
+                failed = process_batch(sources, "P", "model", 3,
+                                       output_dir=out,
+                                       output_format='jsonl',
+                                       quiet=True)
+            self.assertEqual(failed, [sources[1]])
+            results = {}
+            for name in os.listdir(out):
+                with open(os.path.join(out, name)) as file:
+                    records = [json.loads(line) for line in file]
+                results[records[0]['source']] = records
+            self.assertEqual([r['content'] for r in results[sources[0]]],
+                             ["P\n\nAA.", "P\n\nBB."])
+            self.assertEqual(results[sources[1]][0]['error'], "boom")
+
+
+class TestMapReduce(unittest.TestCase):
+    def test_group_for_context(self):
+        budget = ChunkBudget(10, 'chars')
+        self.assertEqual(group_for_context(["aaa", "bbb", "ccc"], budget),
+                         [["aaa", "bbb"], ["ccc"]])
+        # oversized texts are still paired so the list always shrinks
+        self.assertEqual(group_for_context(["a" * 20] * 3, budget),
+                         [["a" * 20] * 2, ["a" * 20]])
+        self.assertEqual(group_for_context([], budget), [])
+
+    def test_summarize_all_reduces_to_one_record(self):
+        calls = []
+
+        async def fake(client, semaphore, message, model, instructions=None):
+            calls.append(message)
+            return "s"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "a.txt")
+            with open(source, 'w') as file:
+                file.write("aa.bb.cc.dd.")
+            out = os.path.join(tmp, "out")
+            with mock.patch('gpt._complete_async', new=fake), \
+                    mock.patch('gpt.create_async_openai_client',
+                               return_value=mock.AsyncMock()):
+                process_batch([source], "P", "model", 3, output_dir=out,
+                              output_format='jsonl', quiet=True,
+                              summarize_all=True)
+            with open(os.path.join(out, os.listdir(out)[0])) as file:
+                records = [json.loads(line) for line in file]
+        self.assertEqual(records, [{"source": source, "model": "model",
+                                    "content": "s"}])
+        # four map calls, then pairs of "s" reduced level by level
+        self.assertEqual(len(calls), 7)
+
+    def test_failed_chunks_are_marked(self):
+        combined = []
+
+        async def fake(client, semaphore, message, model, instructions=None):
+            if instructions == gpt.REDUCE_PROMPT:
+                combined.append(message)
+                return "all"
+            if message.startswith("bb"):
+                raise Overloaded("down")
+            return "s"
+
+        status = []
+        index = ChunkIndex(ChunkBudget(3, 'chars'), "aa.bb.")
+        with mock.patch('gpt._complete_async', new=fake):
+            content = asyncio.run(gpt._map_reduce(None, None, index, "P",
+                                                  "model", 100, 0,
+                                                  status.append))
+        self.assertEqual(content, "all")
+        self.assertEqual(combined,
+                         ["s\n\n[Chunk 2 (3-6) could not be summarized.]"])
+        self.assertTrue(any("chunk 2" in line for line in status))
+
+    def test_all_chunks_failing_raises(self):
+        async def fake(client, semaphore, message, model, instructions=None):
+            raise Overloaded("down")
+
+        index = ChunkIndex(ChunkBudget(3, 'chars'), "aa.bb.")
+        with mock.patch('gpt._complete_async', new=fake):
+            with self.assertRaises(Overloaded):
+                asyncio.run(gpt._map_reduce(None, None, index, "P", "model",
+                                            100))
+
+    def test_async_requests_are_retried(self):
+        response = SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(
+                        content="ok"))],
+                usage=None)
+        client = mock.Mock()
+        client.chat.completions.create = mock.AsyncMock(
+                side_effect=[Overloaded(), response])
+        with mock.patch('gpt._retry_delay', return_value=0), \
+                mock.patch('gpt.recorder', metrics.Recorder()):
+            content = asyncio.run(gpt._complete_async(
+                    client, asyncio.Semaphore(1), "q", "model"))
+            entry = gpt.recorder.select("request")[0]
+        self.assertEqual(content, "ok")
+        self.assertEqual(entry["retries"], 1)
+
+
 # This allows the test script to be run directly from the command line.
 if __name__ == '__main__':
     unittest.main()
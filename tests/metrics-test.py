@@ -0,0 +1,49 @@
+import json
+import os
+import tempfile
+import unittest
+
+from metrics import Recorder, percentile
+
+
+class TestPercentile(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(percentile(values, 50), 3)
+        self.assertEqual(percentile(values, 95), 5)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertIsNone(percentile([], 50))
+
+
+class TestRecorder(unittest.TestCase):
+    def test_trace_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.jsonl")
+            recorder = Recorder(path)
+            recorder.record("request", model="m", latency=1.5)
+            recorder.record("fetch", url="u", seconds=0.5)
+            recorder.close()
+            with open(path) as file:
+                entries = [json.loads(line) for line in file]
+        self.assertEqual([e["kind"] for e in entries], ["request", "fetch"])
+        self.assertEqual(entries[0]["latency"], 1.5)
+
+    def test_summary(self):
+        recorder = Recorder()
+        self.assertEqual(recorder.summary(), "No requests yet.")
+        for latency in (1.0, 2.0, 3.0):
+            recorder.record("request", ttft=0.5, latency=latency,
+                            completion_chars=100, bytes=100)
+        recorder.record("request", cache="hit", ttft=0.0, latency=0.0)
+        recorder.record("request", error="boom")
+        recorder.record("extract", seconds=2.0)
+        summary = recorder.summary()
+        self.assertIn("requests: 5 (1 cached, 1 errors)", summary)
+        self.assertIn("latency: p50 2.00s p95 3.00s", summary)
+        self.assertIn("ttft: p50 0.50s", summary)
+        self.assertIn("throughput: 50 chars/s, 300 bytes streamed", summary)
+        self.assertIn("extract: 1 p50 2.00s", summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import cache
+import nhk
+
+INDEX = """<html><body><dl>
+<dd><a href="/news/html/1.html"><em class="title">First</em></a></dd>
+<dd><a href="/news/html/2.html"><em class="title">Second</em></a></dd>
+<dd><span>No link</span></dd>
+</dl></body></html>"""
+
+ARTICLE = """<html><body><nav>Menu</nav>
+<section class="content--body">
+<p>Body text.</p>
+
+
+</section></body></html>"""
+
+
+class TestParse(unittest.TestCase):
+    def test_index(self):
+        self.assertEqual(nhk.parse_index(INDEX),
+                         [("First", "/news/html/1.html"),
+                          ("Second", "/news/html/2.html")])
+
+    def test_article(self):
+        self.assertEqual(nhk.parse_article(ARTICLE), "Body text.")
+
+
+class TestFetch(unittest.TestCase):
+    def test_index_is_revalidated(self):
+        requests = []
+
+        def get(url, headers=None, **kwargs):
+            requests.append(headers)
+            if headers.get('If-None-Match') == '"v1"':
+                return SimpleNamespace(status_code=304,
+                                       headers={'ETag': '"v1"'})
+            return SimpleNamespace(status_code=200, headers={'ETag': '"v1"'},
+                                   content=INDEX.encode('utf-8'))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            http = cache.HttpCache(os.path.join(tmpdir, "http.db"))
+            with mock.patch.object(nhk, 'http_cache', http), \
+                    mock.patch('web.get', get):
+                self.assertEqual(nhk.fetch(nhk.INDEX_URL), INDEX)
+                self.assertEqual(nhk.fetch(nhk.INDEX_URL), INDEX)
+        self.assertEqual(requests[1], {'If-None-Match': '"v1"'})
+
+    def test_error(self):
+        response = SimpleNamespace(status_code=404)
+        with mock.patch('web.get', return_value=response):
+            with self.assertRaises(nhk.FetchError):
+                nhk.fetch(nhk.INDEX_URL)
+
+
+class TestArticlePrefetcher(unittest.TestCase):
+    def test_fetches_concurrently_once(self):
+        hrefs = [f"/news/{i}.html" for i in range(4)]
+        barrier = threading.Barrier(len(hrefs), timeout=5)
+        calls = []
+
+        def fetch_article(href):
+            calls.append(href)
+            # every fetch must be in flight at the same time
+            barrier.wait()
+            return href
+
+        prefetcher = nhk.ArticlePrefetcher(workers=len(hrefs))
+        with mock.patch.object(nhk, 'fetch_article', fetch_article):
+            prefetcher.prefetch(hrefs)
+            self.assertEqual([prefetcher.get(h) for h in hrefs], hrefs)
+            prefetcher.prefetch(hrefs)
+        prefetcher.close()
+        self.assertEqual(sorted(calls), hrefs)
+
+    def test_failures_are_retried(self):
+        results = [nhk.FetchError("down"), "text"]
+
+        def fetch_article(href):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        prefetcher = nhk.ArticlePrefetcher(workers=1)
+        with mock.patch.object(nhk, 'fetch_article', fetch_article):
+            with self.assertRaises(nhk.FetchError):
+                prefetcher.get("/a")
+            self.assertEqual(prefetcher.get("/a"), "text")
+        prefetcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from search import BM25Index, tokenize
+
+
+class TestTokenize(unittest.TestCase):
+    def test_words(self):
+        self.assertEqual(tokenize("Hello, World! v2"), ["hello", "world", "v2"])
+
+    def test_cjk_bigrams(self):
+        self.assertEqual(tokenize("東京都 and 雨"),
+                         ["東京", "京都", "and", "雨"])
+
+
+class TestBM25Index(unittest.TestCase):
+    def setUp(self):
+        self.index = BM25Index()
+        self.index.add("The cat sat on the mat.")
+        self.index.add("Dogs chase cats and cars.")
+        self.index.add("Quantum computing uses qubits. Qubits are fragile.")
+        self.index.add("東京の天気は晴れです。")
+
+    def test_ranks_relevant_documents(self):
+        results = self.index.search("what are qubits", 2)
+        self.assertEqual(results[0][0], 2)
+        self.assertEqual(len(results), 1)
+
+    def test_cjk_query(self):
+        self.assertEqual(self.index.search("東京の天気")[0][0], 3)
+
+    def test_no_match(self):
+        self.assertEqual(self.index.search("zebra"), [])
+        self.assertEqual(BM25Index().search("cat"), [])
+
+    def test_top_k(self):
+        self.assertEqual(len(self.index.search("the cat cats dogs", 1)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
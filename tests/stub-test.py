@@ -0,0 +1,90 @@
+import contextlib
+import io
+import os
+import unittest
+from unittest import mock
+
+import gpt
+import metrics
+import stub
+
+
+class TestFixtures(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = stub.start_fixture_server()
+        cls.base = stub.server_url(cls.server)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def test_pdf_fixture_extracts(self):
+        text = ''.join(gpt.iter_url_text(self.base + "/doc.pdf?n=2"))
+        self.assertGreater(len(text), 1000)
+        pages = ''.join(gpt.iter_url_text(self.base + "/doc.pdf?n=2", "2"))
+        self.assertTrue(text.endswith(pages))
+
+    def test_html_fixture_extracts(self):
+        text = ''.join(gpt.iter_url_text(self.base + "/doc.html?n=3"))
+        self.assertIn("Fixture article", text)
+        self.assertNotIn("var fixture", text)
+
+
+class TestChatStub(unittest.TestCase):
+    def setUp(self):
+        self.config = stub.StubConfig(tokens_per_sec=10000,
+                                      first_token_delay=0,
+                                      reply_tokens=5)
+        self.server = stub.start_chat_stub(config=self.config)
+        env = {"OPENAI_BASE_URL": stub.server_url(self.server) + "/v1",
+               "OPENAI_API_KEY": "stub"}
+        patches = [mock.patch.dict(os.environ, env),
+                   mock.patch('gpt.openai_client', None),
+                   mock.patch('gpt.recorder', metrics.Recorder()),
+                   mock.patch('gpt.time.sleep')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.server.shutdown)
+
+    def send(self, message):
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            return gpt._send(message, None, "stub")
+
+    def test_streams_reply(self):
+        self.assertEqual(self.send("hello"),
+                         "Stub reply to 5 chars. of and to in")
+        self.assertEqual(self.config.requests[0]["model"], "stub")
+        self.assertTrue(self.config.requests[0]["stream"])
+
+    def test_reports_cached_prefix(self):
+        memory = gpt.ConversationMemory(10000)
+        with mock.patch('gpt.SYSTEM_PROMPT', "system " * 50):
+            self.send_with(memory, "first question")
+            self.send_with(memory, "second question")
+        first, second = gpt.recorder.select("request")
+        self.assertEqual(first["cached_tokens"], 0)
+        # the whole first prompt is a prefix of the second one
+        self.assertEqual(second["cached_tokens"], first["usage_prompt_tokens"])
+        self.assertIn("prompt tokens:", gpt.recorder.summary())
+
+    def send_with(self, memory, message):
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            return gpt._send(message, memory, "stub")
+
+    def test_complete(self):
+        self.assertTrue(gpt._complete("hi", "stub").startswith("Stub reply"))
+
+    def test_injected_errors_are_retried(self):
+        self.config.fail_next = 2
+        self.config.error_status = 429
+        self.assertTrue(self.send("hello").startswith("Stub reply"))
+        self.assertEqual(len(self.config.requests), 3)
+        self.assertEqual(gpt.recorder.select("request")[0]["retries"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import cache
+import watch
+
+from watch import Poller, SeenSet, Source, check, make_source
+
+
+class TestSeenSet(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "seen.bin")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_persists(self):
+        seen = SeenSet(self.path)
+        seen.add(["nhk:/a", "nhk:/b"])
+        seen.add(["nhk:/b", "nhk:/c"])
+        self.assertEqual(os.path.getsize(self.path), 3 * 8)
+
+        seen = SeenSet(self.path)
+        self.assertIn("nhk:/a", seen)
+        self.assertIn("nhk:/c", seen)
+        self.assertNotIn("nhk:/d", seen)
+
+    def test_keeps_newest(self):
+        seen = SeenSet(self.path, limit=3)
+        for key in "abcde":
+            seen.add([key])
+        self.assertNotIn("a", seen)
+        self.assertNotIn("b", seen)
+        self.assertEqual(len(SeenSet(self.path)), 3)
+        self.assertIn("e", SeenSet(self.path))
+
+
+def listing(*hrefs):
+    return ''.join(f"<a href='{href}'>{href}</a>" for href in hrefs)
+
+
+def parse(html):
+    hrefs = [part.split("'")[0] for part in html.split("href='")[1:]]
+    return [(href, href.upper(), href) for href in hrefs]
+
+
+class TestPoller(unittest.TestCase):
+    def test_not_modified_is_not_parsed(self):
+        pages = [listing("/a"), listing("/a"), listing("/a", "/b")]
+        requests = []
+
+        def get(url, headers=None, **kwargs):
+            requests.append(headers)
+            content = pages.pop(0).encode('utf-8')
+            if headers.get('If-None-Match') == f'"{len(content)}"':
+                return SimpleNamespace(status_code=304, headers={})
+            return SimpleNamespace(status_code=200, content=content,
+                                   headers={'ETag': f'"{len(content)}"'})
+
+        source = Source("test", "https://example.com/", parse)
+        parsed = mock.Mock(side_effect=parse)
+        source.parse = parsed
+        with tempfile.TemporaryDirectory() as tmpdir:
+            poller = Poller(cache.HttpCache(os.path.join(tmpdir, "h.db")))
+            with mock.patch('web.get', get):
+                self.assertEqual(len(poller.poll(source)), 1)
+                self.assertEqual(poller.poll(source), [])
+                self.assertEqual(len(poller.poll(source)), 2)
+        self.assertIn('If-None-Match', requests[1])
+        self.assertEqual(parsed.call_count, 2)
+
+
+class TestCheck(unittest.TestCase):
+    def test_shows_only_new_items(self):
+        pages = [[("/a", "A", "u/a"), ("/b", "B", "u/b")],
+                 [("/b", "B", "u/b"), ("/c", "C", "u/c"), ("/c", "C", "u/c")]]
+        poller = SimpleNamespace(poll=lambda source: pages.pop(0))
+        source = Source("test", "https://example.com/", None)
+
+        summarizer = mock.Mock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            seen = SeenSet(os.path.join(tmpdir, "seen.bin"))
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output), \
+                    contextlib.redirect_stderr(io.StringIO()) as err:
+                first = check([source], poller, seen, summarizer)
+                second = check([source], poller, seen, summarizer)
+
+        # what is listed when a source is added is only recorded
+        self.assertEqual(first, [])
+        self.assertIn("watching 2", err.getvalue())
+        self.assertEqual(second, [("test", "C", "u/c")])
+        self.assertEqual(output.getvalue(), "[test] C\n  u/c\n")
+        self.assertEqual(summarizer.submit.call_count, 1)
+
+    def test_catch_up(self):
+        pages = [[("/a", "A", "u/a")], [("/a", "A", "u/a")]]
+        poller = SimpleNamespace(poll=lambda source: pages.pop(0))
+        source = Source("test", "https://example.com/", None)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            seen = SeenSet(os.path.join(tmpdir, "seen.bin"))
+            with contextlib.redirect_stdout(io.StringIO()):
+                first = check([source], poller, seen, catch_up=True)
+                second = check([source], poller, seen, catch_up=True)
+        self.assertEqual(first, [("test", "A", "u/a")])
+        self.assertEqual(second, [])
+
+    def test_failed_source_is_skipped(self):
+        def poll(source):
+            raise RuntimeError("Failed to retrieve the web page: 503")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            seen = SeenSet(os.path.join(tmpdir, "seen.bin"))
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                found = check([Source("test", "u", None)],
+                              SimpleNamespace(poll=poll), seen)
+        self.assertEqual(found, [])
+        self.assertIn("503", err.getvalue())
+
+
+class TestMakeSource(unittest.TestCase):
+    def test_sources(self):
+        self.assertEqual(make_source("nhk").url, watch.nhk.INDEX_URL)
+        self.assertIn("/category/science/", make_source("wr:science").url)
+        self.assertIn("/list/cs.AI/", make_source("arxiv:cs.AI").url)
+        with self.assertRaises(ValueError):
+            make_source("arxiv")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+import argparse
+import arxiv
+import cache
+import gpt
+import hashlib
+import nhk
+import os
+import requests
+import sys
+import tc
+import threading
+import time
+import web
+import wr
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+WATCH_INTERVAL_SEC = int(os.getenv("GPT_WATCH_INTERVAL", 300))
+SEEN_LIMIT = 100000
+SUMMARY_WORKERS = 2
+
+
+def item_hash(key):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class SeenSet:
+    # 64-bit hashes of seen items, appended to a flat file of uint64s
+    # and trimmed to the newest `limit` entries
+    def __init__(self, path=None, limit=SEEN_LIMIT):
+        if path is None:
+            path = os.path.join(cache.CACHE_DIR, "seen.bin")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.hashes = array('Q')
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                data = file.read()
+            self.hashes.frombytes(data[:len(data) - len(data) % 8])
+        self.members = set(self.hashes)
+
+    def __contains__(self, key):
+        return item_hash(key) in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, keys):
+        with self.lock:
+            added = array('Q')
+            for key in keys:
+                value = item_hash(key)
+                if value not in self.members:
+                    self.members.add(value)
+                    added.append(value)
+            if not added:
+                return
+            self.hashes.extend(added)
+
+            if len(self.hashes) > self.limit:
+                self.hashes = self.hashes[-self.limit:]
+                self.members = set(self.hashes)
+                with open(self.path, 'wb') as file:
+                    self.hashes.tofile(file)
+            else:
+                with open(self.path, 'ab') as file:
+                    added.tofile(file)
+
+
+class Source:
+    def __init__(self, name, url, parse):
+        self.name = name
+        self.url = url
+        # html -> [(key, title, url)]
+        self.parse = parse
+
+
+def make_source(spec):
+    name, _, arg = spec.partition(':')
+
+    if name == 'nhk':
+        return Source(spec, nhk.INDEX_URL, lambda html: [
+                (href, title, nhk.BASE_URL.format(href=href))
+                for title, href in nhk.parse_index(html)])
+    if name == 'tc':
+        return Source(spec, tc.URL, lambda html: [
+                (href, title, href) for title, href in tc.parse_index(html)])
+    if name == 'wr':
+        return Source(spec, wr.index_url(arg or None), lambda html: [
+                (href, title, href) for title, href in wr.parse_index(html)])
+    if name == 'arxiv' and arg:
+        url = arxiv.BASE_URL.format(category=arg, skip=0, show=arxiv.SHOW)
+        return Source(spec, url, lambda html: [
+                (arxiv_id, title, f"https://arxiv.org/pdf/{arxiv_id}.pdf")
+                for arxiv_id, title, _ in arxiv.parse_listing(html)])
+
+    raise ValueError(f"Unknown source: {spec} "
+                     + "(nhk, tc, wr[:category] or arxiv:category)")
+
+
+class Poller:
+    def __init__(self, http=None):
+        self.http = http
+        self.digests = {}
+
+    def poll(self, source):
+        if self.http is not None:
+            response = self.http.fetch(source.url, web.get)
+        else:
+            response = web.get(source.url)
+
+        if response.status_code != 200:
+            raise RuntimeError(
+                    f"Failed to retrieve the web page: {response.status_code}")
+
+        # a 304 or an identical body costs no parsing after the first poll
+        known = self.digests.get(source.url)
+        if known is not None and getattr(response, 'not_modified', False):
+            return []
+        digest = hashlib.sha256(response.content).hexdigest()
+        if digest == known:
+            return []
+        self.digests[source.url] = digest
+
+        return source.parse(response.content.decode('utf-8', 'replace'))
+
+
+def summarize(url, output_dir, model):
+    failed = gpt.process_batch([url],
+                               gpt.DEFAULT_PROMPT,
+                               model,
+                               gpt.DEFAULT_CHUNK_SIZE,
+                               output_dir=output_dir,
+                               quiet=True,
+                               summarize_all=True)
+    if failed:
+        print(f"  summary failed: {url}")
+    else:
+        path = os.path.join(output_dir, gpt._batch_file_name(url) + ".md")
+        print(f"  summary: {path}")
+
+
+def check(sources, poller, seen, summarizer=None, output_dir=None,
+          model=gpt.GPT35, catch_up=False):
+    found = []
+    for source in sources:
+        try:
+            items = poller.poll(source)
+        except (RuntimeError, requests.RequestException) as e:
+            print(f"[{source.name}] {e}", file=sys.stderr)
+            continue
+
+        new = []
+        keys = set()
+        for key, title, url in items:
+            key = f"{source.name}:{key}"
+            if key in seen or key in keys:
+                continue
+            keys.add(key)
+            new.append((source.name, title, url))
+
+        # a source seen for the first time only records what is listed,
+        # so adding one does not show or summarize its whole page
+        primed = f"{source.name}\0"
+        if primed not in seen:
+            keys.add(primed)
+            if not catch_up:
+                print(f"[{source.name}] watching {len(new)} listed items",
+                      file=sys.stderr)
+                new = []
+        seen.add(keys)
+
+        for name, title, url in new:
+            print(f"[{name}] {title}")
+            print(f"  {url}")
+            if summarizer is not None:
+                summarizer.submit(summarize, url, output_dir, model)
+        found.extend(new)
+    return found
+
+
+def watch(sources, interval=WATCH_INTERVAL_SEC, summary_dir=None,
+          model=gpt.GPT35, once=False, catch_up=False):
+    poller = Poller(gpt.http_cache)
+    seen = SeenSet()
+
+    summarizer = None
+    if summary_dir is not None:
+        os.makedirs(summary_dir, exist_ok=True)
+        summarizer = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS)
+
+    try:
+        while True:
+            check(sources, poller, seen, summarizer, summary_dir, model,
+                  catch_up)
+            if once:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        if summarizer is not None:
+            summarizer.shutdown(wait=once, cancel_futures=not once)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                        description="Watch news and arXiv listings and "
+                                    + "show only items not seen before.")
+
+    parser.add_argument('sources',
+                        nargs='+',
+                        help="Sources to watch: nhk, tc, wr, "
+                             + "wr:CATEGORY or arxiv:CATEGORY.")
+    parser.add_argument('-i',
+                        '--interval',
+                        type=int,
+                        default=WATCH_INTERVAL_SEC,
+                        help="Seconds between checks "
+                             + f"(default {WATCH_INTERVAL_SEC}).")
+    parser.add_argument('--once',
+                        action='store_true',
+                        help="Check once and exit.")
+    parser.add_argument('--catch-up',
+                        action='store_true',
+                        help="Also show (and summarize) what is already "
+                             + "listed when a source is watched for the "
+                             + "first time.")
+    parser.add_argument('--summarize',
+                        metavar='DIR',
+                        nargs='?',
+                        const=os.path.join(cache.CACHE_DIR, "summaries"),
+                        help="Summarize new items in the background and "
+                             + "write them to DIR (default "
+                             + "~/.gpt_cache/summaries).")
+    parser.add_argument('-m',
+                        '--model',
+                        help="Model for --summarize: 3, 4, or an "
+                             + "explicit OpenAI model name.",
+                        default="3")
+
+    args = parser.parse_args()
+
+    if args.model == '3':
+        args.model = gpt.GPT35
+    elif args.model == '4':
+        args.model = gpt.GPT4
+
+    try:
+        sources = [make_source(spec) for spec in args.sources]
+    except ValueError as e:
+        parser.error(str(e))
+
+    gpt.init_caches()
+
+    watch(sources, args.interval, args.summarize, args.model, args.once,
+          args.catch_up)
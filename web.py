@@ -0,0 +1,59 @@
+import os
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT_SEC = int(os.getenv("GPT_HTTP_TIMEOUT", 30))
+POOL_SIZE = 10
+RETRY_COUNT = 3
+RETRY_BACKOFF_SEC = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, timeout=DEFAULT_TIMEOUT_SEC, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def create_session():
+    retry = Retry(total=RETRY_COUNT,
+                  backoff_factor=RETRY_BACKOFF_SEC,
+                  status_forcelist=RETRY_STATUSES,
+                  allowed_methods=frozenset(['GET', 'HEAD']),
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+    adapter = TimeoutHTTPAdapter(pool_connections=POOL_SIZE,
+                                 pool_maxsize=POOL_SIZE,
+                                 max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # includes br (and zstd) when urllib3 can decode them
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+
+def get_session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+    return _session
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **kwargs)
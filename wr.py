@@ -1,13 +1,16 @@
 import argparse
-import os
-import requests
+import extract
+import gpt
+import re
 import unicodedata
+import web
 
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 from prompt_toolkit.history import InMemoryHistory
 from prompt_toolkit.shortcuts import prompt
 
 KEYS = ['u', 'i', 'o', 'p']
+URL = "https://www.wired.com"
 
 history = InMemoryHistory()
 
@@ -17,18 +20,37 @@ def normalize_unicode(text):
     return ascii_text
 
 
-def get(category=None):
+def index_url(category=None):
+    if category is None:
+        return URL
+    return URL + f"/category/{category}/"
+
+
+def parse_index(html_content):
+    soup = extract.soup(html_content, SoupStrainer(
+            "a", class_=re.compile("^SummaryItemHedLink")))
+
+    links = []
+    existing_hrefs = set()
 
-    url = "https://www.wired.com"
+    for a in soup.select('a[class^="SummaryItemHedLink"]'):
+        href = URL + a.get('href')
+        title = a.text.strip()
+        if len(title) > 0:
+            if href not in existing_hrefs:
+                links.append((title, href))
+                existing_hrefs.add(href)
+
+    return links
+
+
+def get(category=None):
 
     global history
 
     while True:
 
-        if category is None:
-            response = requests.get(url)
-        else:
-            response = requests.get(url + f"/category/{category}/")
+        response = web.get(index_url(category))
 
         if response.status_code == 200:
             response.encoding = 'utf-8'
@@ -38,18 +60,7 @@ def get(category=None):
             html_content = ""
             return
 
-        soup = BeautifulSoup(html_content, "html.parser")
-
-        links = []
-        existing_hrefs = set()
-
-        for a in soup.select('a[class^="SummaryItemHedLink"]'):
-            href = url + a.get('href')
-            title = a.text.strip()
-            if len(title) > 0:
-                if href not in existing_hrefs:
-                    links.append((title, href))
-                    existing_hrefs.add(href)
+        links = parse_index(html_content)
 
         idx = 0
 
@@ -90,9 +101,12 @@ def get(category=None):
                     print("---")
                     continue
 
-            command = f"gpt {links[idx + k][1]}"
-            print(command)
-            os.system(command)
+            url = links[idx + k][1]
+            print(url)
+            try:
+                gpt.read_and_process(url)
+            except KeyboardInterrupt:
+                print()
             print("---")
 
 
@@ -106,5 +120,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    gpt.init_caches()
+
     get(args.category)
 